@@ -1,21 +1,24 @@
 #!/usr/bin/python2.7
 
+from bson import BSON
 from bson.objectid import ObjectId
 from collections import OrderedDict
 from copy import copy, deepcopy
 from datetime import datetime, timedelta
 import json
 from bson import json_util
-import inspect
 import operator
 import os
 import random
 import socket
+import sys
+import threading
 import unicodedata
 from user_agents import parse as ua_parse
 
 from flask import request, Response
 
+import encoders
 import utils
 import models
 import settings
@@ -49,6 +52,106 @@ class AssetLoadError(Exception):
         self.logger.exception(message)
         Exception.__init__(self, message)
 
+class AssetConcurrencyError(Exception):
+    """ Raised by UserAsset.save() when the asset's MDB document has been
+    modified (by some other request) since we loaded it. """
+
+    def __init__(self, message="Asset was modified by another request!"):
+        self.logger = utils.get_logger()
+        self.logger.warn(message)
+        Exception.__init__(self, message)
+
+
+#
+#   The game asset registry. AssetCollection objects are built exactly once per
+#       process; every Assets() call after the first gets a cheap instance that
+#       shares the frozen, already-built 'assets' dict of the first one.
+#
+
+class FrozenAsset(dict):
+    """ A read-only asset dictionary. Copying one of these (e.g. via the
+    AssetCollection.get_asset() method) gets you a normal, mutable dict. """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Game asset dictionaries are read-only! Use get_asset() to get a copy.")
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return deepcopy(dict(self), memo)
+
+
+class FrozenAssetDict(OrderedDict):
+    """ A read-only version of an AssetCollection's 'assets' dict. Its values
+    are FrozenAsset dicts. AssetCollection methods that need to modify the
+    'assets' dict (e.g. filter()) swap in a copy before they do it. """
+
+    def __init__(self, *args, **kwargs):
+        OrderedDict.__init__(self, *args, **kwargs)
+        self._frozen = True
+
+    def __setitem__(self, key, value, *args, **kwargs):
+        if getattr(self, '_frozen', False):
+            raise TypeError("AssetCollection 'assets' dictionaries are read-only!")
+        if isinstance(value, dict) and not isinstance(value, FrozenAsset):
+            value = FrozenAsset(value)
+        OrderedDict.__setitem__(self, key, value, *args, **kwargs)
+
+    def __delitem__(self, key, *args, **kwargs):
+        if getattr(self, '_frozen', False):
+            raise TypeError("AssetCollection 'assets' dictionaries are read-only!")
+        OrderedDict.__delitem__(self, key, *args, **kwargs)
+
+    def clear(self):
+        if getattr(self, '_frozen', False):
+            raise TypeError("AssetCollection 'assets' dictionaries are read-only!")
+        OrderedDict.clear(self)
+
+    def thaw(self):
+        """ Returns a mutable copy of the dict: the top-level is a new
+        OrderedDict, but the individual asset dicts are still FrozenAsset
+        objects (i.e. copy them before you change them). """
+        return OrderedDict(self)
+
+
+class AssetRegistry(type):
+    """ Metaclass for AssetCollection. Keeps one fully-initialized instance of
+    each Assets() class per process and hands out new instances that share its
+    (frozen) 'assets' dict, rather than re-scraping the assets/ module, copying
+    every dict, setting pretty types, etc. every time something calls
+    models.whatever.Assets().
+
+    Assets() objects initialized with args/kwargs are not registered.
+
+    API workers are threaded, so everything here (and the name memos of the
+    registered collections) is only touched with 'lock' held. It's an RLock
+    because building one collection can build others. """
+
+    registry = {}
+    catalogs = {}       # pre-encoded 'assets' dicts; see get_catalog() below
+    lock = threading.RLock()
+
+    def __call__(cls, *args, **kwargs):
+
+        if args or kwargs:
+            return type.__call__(cls, *args, **kwargs)
+
+        with AssetRegistry.lock:
+            prototype = AssetRegistry.registry.get(cls, None)
+            if prototype is None:
+                prototype = type.__call__(cls)
+                prototype.assets = FrozenAssetDict(prototype.assets)
+                prototype.set_name_indexes()
+                AssetRegistry.registry[cls] = prototype
+
+        collection = cls.__new__(cls)
+        collection.__dict__.update(prototype.__dict__)
+        return collection
+
 
 class AssetCollection(object):
     """ The base class for game asset objects, i.e. working with the dict assets
@@ -60,8 +163,12 @@ class AssetCollection(object):
     Most Asset() objects that use this as their base class will define their own
     self.assets dict, e.g. in their __init__() method. But is not mandatory:
     review the __init__ method of this class carefully before writing custom
-    __init__ code in in an individual Asset() object module. """
+    __init__ code in in an individual Asset() object module.
+
+    AssetCollection objects are built once per process and then re-used: see
+    AssetRegistry above. Their 'assets' dicts are read-only after that. """
 
+    __metaclass__ = AssetRegistry
 
     def __repr__(self):
         if not hasattr(self, 'type'):
@@ -169,6 +276,40 @@ class AssetCollection(object):
             self.assets[k] = all_assets[k]
 
 
+    def set_name_indexes(self):
+        """ Creates the lookup dictionaries used by the name-based 'get' methods
+        below, i.e. so that we don't have to iterate over self.assets every time
+        we want to get an asset from its name.
+
+        Creates four dicts, all of which map to asset handles:
+
+            - self.name_index: keys are asset 'name' values
+            - self.name_index_upper: keys are upper() 'name' values
+            - self.misspellings_index: keys are values from the asset's
+                'misspellings' list (if it has one)
+            - self.decomposed_name_index: starts out empty; keys are names
+                that get_handle_from_decomposed_name() has already looked up
+
+        These get built automatically the first time they're needed (and once
+        per process for collections in the AssetRegistry). Anything that
+        modifies self.assets after initialization should set self.name_index
+        to None (see filter() below) so that they get re-built.
+        """
+
+        self.name_index = {}
+        self.name_index_upper = {}
+        self.misspellings_index = {}
+        self.decomposed_name_index = {}
+
+        for a in self.assets.keys():
+            a_dict = self.assets[a]
+            if "name" in a_dict:
+                self.name_index[a_dict["name"]] = a
+                self.name_index_upper[a_dict["name"].upper()] = a
+            for m in a_dict.get("misspellings", []):
+                self.misspellings_index[m] = a
+
+
     def set_pretty_types(self, capitalize=True):
         """ Iterates over self.assets; adds the "type_pretty" and 'sub_type_pretty'
         to all assets in the AssetCollection.assets dict """
@@ -317,24 +458,69 @@ class AssetCollection(object):
         if name == 'White Box':
             name = 'White Box & Promo'
 
-        if not case_sensitive:
-            name = name.upper()
-
-        name_lookup = {}
-        for a in self.assets.keys():
-            if "name" in self.assets[a]:
-                if case_sensitive:
-                    name_lookup[self.assets[a]["name"]] = a
-                elif not case_sensitive:
-                    asset_name_upper = self.assets[a]["name"].upper()
-                    name_lookup[asset_name_upper] = a
-
-        if name in name_lookup.keys():
-            return self.get_asset(name_lookup[name])
+        handle = self.get_handle_from_name(name, case_sensitive)
+        if handle is not None:
+            return self.get_asset(handle)
         else:
             return None
 
 
+    def get_handle_from_name(self, name, case_sensitive=False):
+        """ Returns the handle of the asset whose 'name' is 'name' or None if
+        there is no such asset. Uses the name indexes (see set_name_indexes()),
+        so this is a dictionary lookup rather than an iteration. """
+
+        if getattr(self, 'name_index', None) is None:
+            self.set_name_indexes()
+
+        if case_sensitive:
+            return self.name_index.get(name, None)
+        return self.name_index_upper.get(name.upper(), None)
+
+
+    def get_handle_from_misspelling(self, name):
+        """ Returns the handle of the asset that has 'name' in its list of
+        'misspellings' or None. Like get_handle_from_name(), this uses an index,
+        so it's cheap. """
+
+        if getattr(self, 'name_index', None) is None:
+            self.set_name_indexes()
+
+        return self.misspellings_index.get(name, None)
+
+
+    def get_handle_from_decomposed_name(self, name):
+        """ Uses utils.decompose_name_string() to split 'name' into variations
+        (i.e. 'White Lion Lvl 2' becomes 'White', 'White Lion', 'White Lion Lvl',
+        etc.) and returns the handle of the first one that matches an asset
+        name (case-insensitive) or None, if none of them do.
+
+        Results are memoized (in self.decomposed_name_index), since the same
+        user-supplied names tend to get looked up over and over again. """
+
+        if getattr(self, 'name_index', None) is None:
+            self.set_name_indexes()
+
+        key = name.strip().upper()
+        with AssetRegistry.lock:
+            if key in self.decomposed_name_index:
+                return self.decomposed_name_index[key]
+
+        handle = None
+        for v in utils.decompose_name_string(key):
+            handle = self.name_index_upper.get(v.strip(), None)
+            if handle is not None:
+                break
+
+        # keep the memo from growing without bound on garbage input
+        with AssetRegistry.lock:
+            if len(self.decomposed_name_index) >= 5000:
+                self.decomposed_name_index.clear()
+            self.decomposed_name_index[key] = handle
+
+        return handle
+
+
 
     def filter(self, filter_attrib=None, filtered_attrib_values=[], reverse=False):
         """ Drops assets from the collection if their 'filter_attrib' value is
@@ -349,6 +535,13 @@ class AssetCollection(object):
             self.logger.error("AssetCollection.filter() method does not accept None or empty list values!")
             return False
 
+        # copy-on-write: never filter the registry's shared 'assets' dict
+        if isinstance(self.assets, FrozenAssetDict):
+            self.assets = self.assets.thaw()
+
+        # our name indexes are going to be stale after this
+        self.name_index = None
+
         for asset_key in self.assets.keys():
             if self.get_asset(asset_key).get(filter_attrib, None) is None:
                 pass
@@ -365,6 +558,26 @@ class AssetCollection(object):
     #   no set/get/filter methods below this point!
     #
 
+    def get_catalog(self):
+        """ Returns the whole 'assets' dict as a utils.PreEncodedResponse,
+        i.e. JSON-encoded and compressed, with an ETag.
+
+        If the collection is the registry's (i.e. its 'assets' dict is still
+        frozen, so it hasn't been filtered, etc.), this only gets done once per
+        process: after that, every Assets() object of this type gets the same
+        PreEncodedResponse. """
+
+        if not isinstance(self.assets, FrozenAssetDict):
+            return utils.PreEncodedResponse(encoders.dumps(self.assets))
+
+        with AssetRegistry.lock:
+            catalog = AssetRegistry.catalogs.get(type(self), None)
+            if catalog is None:
+                catalog = utils.PreEncodedResponse(encoders.dumps(self.assets))
+                AssetRegistry.catalogs[type(self)] = catalog
+            return catalog
+
+
     def request_response(self, a_name=None, a_handle=None):
         """ Processes a JSON request for a specific asset from the collection,
         initializes the asset (if it can) and then calls the asset's serialize()
@@ -372,7 +585,7 @@ class AssetCollection(object):
 
         # first, if the request is a GET, just dump everything and bail
         if request and request.method == "GET":
-            return Response(response=json.dumps(self.assets, default=json_util.default), status=200, mimetype="application/json")
+            return self.get_catalog().response()
 
         # next, if the request has JSON, check for params
         if request and hasattr(request, 'json'):
@@ -381,7 +594,7 @@ class AssetCollection(object):
 
         # if there are no lookups requested, dump everything and bail
         if a_name is None and a_handle is None:
-            return Response(response=json.dumps(self.assets, default=json_util.default), status=200, mimetype="application/json")
+            return self.get_catalog().response()
 
         # finally, do lookups and create a response based on the outcome
         if a_handle is not None:
@@ -392,7 +605,7 @@ class AssetCollection(object):
         if A is None:
             return utils.http_404
 
-        return Response(response=json.dumps(A, default=json_util.default), status=200, mimetype="application/json")
+        return Response(response=encoders.dumps(A), status=200, mimetype="application/json")
 
 
 
@@ -470,13 +683,9 @@ class GameAsset(object):
         if "_" in self.name:
             self.logger.warn("Asset name '%s' contains underscores. Names should use whitespaces." % self.name)
 
-        lookup_dict = {}
-        for asset_handle in self.assets.get_handles():
-            asset_dict = self.assets.get_asset(asset_handle)
-            lookup_dict[asset_dict["name"]] = asset_handle
-
-        if self.name in lookup_dict.keys():
-            self.handle = lookup_dict[self.name]
+        asset_handle = self.assets.get_handle_from_name(self.name, case_sensitive=True)
+        if asset_handle is not None:
+            self.handle = asset_handle
             self.initialize_from_handle()
 
         if self.handle is None:
@@ -534,13 +743,17 @@ class UserAsset(object):
         return "%s object '%s' [%s]" % (self.collection, repr_name, self._id)
 
 
-    def __init__(self, collection=None, _id=None, normalize_on_init=True, new_asset_attribs={}, Settlement=None):
+    def __init__(self, collection=None, _id=None, normalize_on_init=True, new_asset_attribs={}, Settlement=None, mdb_doc=None):
 
         # initialize basic vars
         self.logger = utils.get_logger()
         self.normalize_on_init = normalize_on_init
         self.new_asset_attribs = new_asset_attribs
 
+        # if the caller already has the MDB doc (e.g. from a find() that got a
+        # bunch of them at once), load() uses it instead of doing a find_one()
+        self.prefetched_mdb_doc = mdb_doc
+
         if collection is not None:
             self.collection = collection
         elif hasattr(self,"collection"):
@@ -580,20 +793,188 @@ class UserAsset(object):
 
     def save(self, verbose=True):
         """ Saves the user asset back to either the 'survivors' or 'settlements'
-        collection in mdb, depending on self.collection. """
+        collection in mdb, depending on self.collection.
+
+        If we've got a snapshot of the document as it was when we loaded it,
+        this does an update_one() with only the changes (see get_save_delta()),
+        rather than replacing the whole document.
+
+        Settlement and survivor documents also get a 'revision' int that goes
+        up on every save. The update only matches if the MDB doc still has the
+        revision we loaded: if it doesn't, somebody else saved it first, and we
+        raise an AssetConcurrencyError (see request_broker.py for the retry).
+
+        Survivor saves also bump their settlement's 'related_revision' (see
+        utils.touch_settlements()). """
 
         if self.collection == "settlements":
-            utils.mdb.settlements.save(self.settlement)
+            doc = self.settlement
         elif self.collection == "survivors":
-            utils.mdb.survivors.save(self.survivor)
+            doc = self.survivor
         elif self.collection == "users":
-            utils.mdb.users.save(self.user)
+            doc = self.user
         else:
             raise AssetLoadError("Invalid MDB collection for this asset!")
+
+        written = False
+        if getattr(self, 'mdb_doc_snapshot', None) is None:
+            if self.collection in ['settlements', 'survivors']:
+                doc['revision'] = doc.get('revision', 0) + 1
+            utils.mdb[self.collection].save(doc)
+            utils.record_asset_write(self.collection, doc['_id'])
+            written = True
+        else:
+            snapshot = self.mdb_doc_snapshot.decode()
+            delta = self.get_save_delta(snapshot, doc)
+            query = {'_id': doc['_id']}
+
+            if delta != {} and self.collection in ['settlements', 'survivors']:
+                for op in ['$set', '$unset']:
+                    if 'revision' in delta.get(op, {}):
+                        del delta[op]['revision']
+                    if delta.get(op, None) == {}:
+                        del delta[op]
+                delta['$inc'] = {'revision': 1}
+
+                revision = snapshot.get('revision', None)
+                if revision is None:
+                    query['revision'] = {'$exists': False}
+                else:
+                    query['revision'] = revision
+
+                result = utils.mdb[self.collection].update_one(query, delta)
+                if result.matched_count == 0:
+                    raise AssetConcurrencyError("%s was modified since it was loaded (revision %s)! Refusing to save." % (self, revision))
+                doc['revision'] = (revision or 0) + 1
+                utils.record_asset_write(self.collection, doc['_id'])
+                written = True
+
+            elif delta != {}:
+                utils.mdb[self.collection].update_one(query, delta)
+                utils.record_asset_write(self.collection, doc['_id'])
+                written = True
+
+        if written and self.collection == 'survivors':
+            utils.touch_settlements([doc.get('settlement', None)])
+
+        self.set_mdb_doc_snapshot(doc)
+
         if verbose:
             self.logger.info("Saved %s to mdb.%s successfully!" % (self, self.collection))
 
 
+    def schema_is_current(self):
+        """ Returns a bool indicating whether the asset's MDB document has been
+        through all of the migrations for the object's 'schema_version' (i.e.
+        whether its meta.schema_version is current).
+
+        Assets that don't use schema versions (i.e. that don't have a
+        'schema_version' attribute) are always current. """
+
+        if getattr(self, 'schema_version', None) is None:
+            return True
+
+        doc = getattr(self, self.collection[:-1])
+        return doc.get('meta', {}).get('schema_version', 0) >= self.schema_version
+
+
+    def set_schema_version(self):
+        """ Stamps the asset's MDB document with the object's current
+        'schema_version'. Call this at the end of migrate(). """
+
+        doc = getattr(self, self.collection[:-1])
+        if not 'meta' in doc.keys():
+            doc['meta'] = {}
+        doc['meta']['schema_version'] = self.schema_version
+        self.perform_save = True
+
+
+    def set_mdb_doc_snapshot(self, doc):
+        """ Keeps a (BSON-encoded, i.e. cheap and detached) copy of 'doc' as it
+        is in the MDB, so that save() can work out what has changed. """
+
+        try:
+            self.mdb_doc_snapshot = BSON.encode(doc)
+        except Exception as e:
+            self.logger.error("%s Could not snapshot MDB document! save() will replace the whole document." % self)
+            self.logger.exception(e)
+            self.mdb_doc_snapshot = None
+
+
+    def get_save_delta(self, old_doc, new_doc):
+        """ Compares two versions of an MDB document and returns an update
+        document (i.e. something to feed to update_one()) that gets us from
+        'old_doc' to 'new_doc'. Returns an empty dict if nothing changed.
+
+        This is done key by key, at the top level of the document:
+
+            - keys that are gone get $unset
+            - lists that have only been appended to get a $push/$each
+            - lists of simple values that only had items removed get a $pull
+            - dicts get a $set/$unset for their changed keys (dotted)
+            - anything else that changed gets a $set
+
+        """
+
+        simple_types = (basestring, int, long, float, bool, ObjectId, datetime)
+
+        def safe_key(k):
+            return isinstance(k, basestring) and '.' not in k and not k.startswith('$')
+
+        delta = {'$set': {}, '$unset': {}, '$push': {}, '$pull': {}}
+
+        for k in old_doc.keys():
+            if k not in new_doc:
+                delta['$unset'][k] = ""
+
+        for k, v in new_doc.iteritems():
+            if k == '_id':
+                continue
+            if k not in old_doc:
+                delta['$set'][k] = v
+                continue
+
+            old_v = old_doc[k]
+            if old_v == v:
+                continue
+
+            if isinstance(v, list) and isinstance(old_v, list):
+                # appended to
+                if len(v) > len(old_v) and v[:len(old_v)] == old_v:
+                    delta['$push'][k] = {'$each': v[len(old_v):]}
+                    continue
+
+                # simple values removed (and nothing else changed)
+                removed = [i for i in old_v if i not in v]
+                if (
+                    len(v) < len(old_v) and
+                    removed != [] and
+                    [i for i in old_v if i in v] == v and
+                    all([isinstance(i, simple_types) for i in removed])
+                ):
+                    delta['$pull'][k] = {'$in': removed}
+                    continue
+
+            elif isinstance(v, dict) and isinstance(old_v, dict) and safe_key(k):
+                if all([safe_key(sub_k) for sub_k in set(v.keys()) | set(old_v.keys())]):
+                    for sub_k in old_v.keys():
+                        if sub_k not in v:
+                            delta['$unset']['%s.%s' % (k, sub_k)] = ""
+                    for sub_k, sub_v in v.iteritems():
+                        if sub_k not in old_v or old_v[sub_k] != sub_v:
+                            delta['$set']['%s.%s' % (k, sub_k)] = sub_v
+                    continue
+
+            delta['$set'][k] = v
+
+        for op in delta.keys():
+            if delta[op] == {}:
+                del delta[op]
+
+        return delta
+
+
+    @utils.request_span('load')
     def load(self):
         """ Retrieves an mdb doc using self.collection and makes the document an
         attribute of the object. """
@@ -605,7 +986,7 @@ class UserAsset(object):
             self._id = self.settlement["_id"]
             self.settlement_id = self._id
             self.get_campaign('initialize')     # sets an object
-            self.get_survivors('initialize')    # sets a list of objects
+            self.survivors = None               # lazy; see Settlement.survivors
             self.init_asset_collections()
         elif self.collection == "survivors":
             self.survivor = mdb_doc
@@ -618,6 +999,8 @@ class UserAsset(object):
         else:
             raise AssetLoadError("Invalid MDB collection for this asset!")
 
+        self.set_mdb_doc_snapshot(mdb_doc)
+
 
 
     def return_json(self):
@@ -673,9 +1056,7 @@ class UserAsset(object):
                 if verbose:
                     self.logger.error("Request JSON is missing required parameter '%s'!" % k)
                 if raise_exception:
-                    curframe = inspect.currentframe()
-                    calframe = inspect.getouterframes(curframe, 2)
-                    caller_function = calframe[1][3]
+                    caller_function = sys._getframe(1).f_code.co_name
                     msg = "Insufficient request parameters for this route! The %s() method requires values for the following keys: %s." % (caller_function, utils.list_to_pretty_string(keys))
                     self.logger.exception(msg)
                     self.logger.error("Bad request params were: %s" % self.params)
@@ -737,9 +1118,9 @@ class UserAsset(object):
         output = deepcopy(utils.api_meta)
 
         if output['meta'].keys() != ['webapp','admins','api','object']:
-            stack = inspect.stack()
-            the_class = stack[1][0].f_locals["self"].__class__
-            the_method = stack[1][0].f_code.co_name
+            caller = sys._getframe(1)
+            the_class = caller.f_locals["self"].__class__
+            the_method = caller.f_code.co_name
             msg = "Models.UserAsset.get_serialize_meta() got modified 'meta' (%s) dict during call by %s.%s()!" % (output['meta'].keys(), the_class, the_method)
             self.logger.error(msg)
 
@@ -765,6 +1146,13 @@ class UserAsset(object):
         """ Retrieves the asset's MDB document. Raises a special exception if it
         cannot for some reason. """
 
+        # use (and then forget) a doc handed to us at init time, if we've got one
+        if getattr(self, 'prefetched_mdb_doc', None) is not None:
+            mdb_doc = self.prefetched_mdb_doc
+            self.prefetched_mdb_doc = None
+            if mdb_doc.get("_id", None) == self._id:
+                return mdb_doc
+
         mdb_doc = utils.mdb[self.collection].find_one({"_id": self._id})
         if mdb_doc is None:
             raise AssetLoadError("Asset _id '%s' could not be found in '%s'!" % (self._id, self.collection))
@@ -826,6 +1214,11 @@ class UserAsset(object):
         going to vary somewhat.
 
         That said, none of the kwargs here are mandatory, because context.
+
+        If you pass 'event_type', 'action' and 'key', we don't need to look at
+        the stack at all, so please do that. Legacy calls that leave any of
+        them out get them defaulted from the name of the calling method, which
+        we look up with sys._getframe() (i.e. cheaply) as a fallback.
         """
 
         # 
@@ -836,10 +1229,10 @@ class UserAsset(object):
         if msg is not None:
             msg = msg.encode("ascii",'ignore')
 
-        # 0.) method: determine caller method
-        curframe = inspect.currentframe()
-        calframe = inspect.getouterframes(curframe, 2)
-        method = calframe[2][3]
+        # 0.) method: determine caller method, but only if we need it; frame 1
+        #   is the log_event_exception_manager() wrapper, so the caller is 2
+        if None in [event_type, action, key]:
+            method = sys._getframe(2).f_code.co_name
 
         # 1.) event: determine event type if it's None
         if event_type is None:
@@ -868,8 +1261,8 @@ class UserAsset(object):
         created_by_email = None
         if request:
             if hasattr(request, 'User'):
-                created_by = request.User.user['_id']
-                created_by_email = request.User.user['login']
+                created_by = request.User._id
+                created_by_email = request.User.login
                 if agent is None:
                     agent = "user"
 
@@ -986,15 +1379,19 @@ class UserAsset(object):
 
 #        d['event'] = d['event'].decode('ascii','replace').encode('utf-8','replace')
 
-        # finally, if we had a requester, now that we've settled on a message
-        # text, update the requester's latest action with it
-        if 'created_by' is not None:
-            if request:
+        # if we're in a request, queue the event and the requester's latest
+        # action update in the request's event sink: they get written after
+        # the request is processed (see utils.flush_request_events())
+        if request and hasattr(request, 'event_sink'):
+            if hasattr(request, 'User'):
                 ua_string = str(ua_parse(request.user_agent.string))
-                request.User.set_latest_action(d['event'], ua_string)
-
-        # finally, insert the event (i.e. save)
-        utils.mdb.settlement_events.insert(d)
+                request.event_sink.set_latest_action(request.User, d['event'], ua_string)
+            request.event_sink.add_event(d)
+        else:
+            d['created_on'] = datetime.now()
+            utils.mdb.settlement_events.insert(d)
+            utils.touch_settlements([d.get('settlement_id', None)])
+            utils.event_broker.publish([d])
         self.logger.info("%s event: %s" % (self, d['event']))
 
 
@@ -427,9 +427,12 @@ def unremove_settlement(s_id):
 #
 
 def remove_api_response_data():
-    """ Drops all documents from the mdb.api_response_times collection."""
+    """ Drops all documents from the mdb.api_response_time_buckets collection
+    (and the legacy mdb.api_response_times collection)."""
+    removed = utils.mdb.api_response_time_buckets.remove()
+    print("\n  Removed %s API response time buckets." % removed['n'])
     removed = utils.mdb.api_response_times.remove()
-    print("\n  Removed %s API response time records." % removed)
+    print("  Removed %s legacy API response time records." % removed['n'])
 
 
 
@@ -485,7 +488,7 @@ if __name__ == "__main__":
 
     # work with API response times
     parser.add_option("-A", dest="work_with_api_response_data", default=False, action="store_true", help="Work with API response time data.")
-    parser.add_option("--reset_api_response_data", dest="reset_api_response_data", action="store_true", default=False, help="Use with -A to remove ALL DOCUMENTS from the mdb.api_response_times collection.")
+    parser.add_option("--reset_api_response_data", dest="reset_api_response_data", action="store_true", default=False, help="Use with -A to remove ALL API response time buckets (and legacy records).")
 
     # Killboard
     parser.add_option("-K", dest="killboard", action="store_true", default=False, help="Clean up the Killboard.")
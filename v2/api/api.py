@@ -19,6 +19,7 @@ import socket
 import ssl
 
 # application-specific imports
+import encoders
 import request_broker
 import settings
 import world
@@ -54,6 +55,10 @@ application.config['SECRET_KEY'] = settings.get("api","secret_key","private")
 jwt = flask_jwt_extended.JWTManager(application)
 
 
+# make sure the MDB has the indexes we need
+utils.create_indexes()
+
+
 #
 #   Routes start here! Settings object initialized above...
 #
@@ -80,10 +85,11 @@ def favicon():
 
 # asset lookups
 @application.route("/game_asset/<asset_collection>", methods=["GET","POST","OPTIONS"])
-@utils.crossdomain(origin=['*'],headers=['Authorization','Content-Type','Access-Control-Allow-Origin'])
+@utils.crossdomain(origin=['*'],headers=['Authorization','Content-Type','Access-Control-Allow-Origin','If-None-Match'])
 def lookup_asset(asset_collection):
     """ Looks up game asset collection assets. Or, if you GET it, dumps the whole
-    asset collection object """
+    asset collection object (pre-encoded, so send If-None-Match and
+    Accept-Encoding headers if you can) """
     return request_broker.get_game_asset(asset_collection)
 
 # deprecation warnings: maintain until 2018-03-10
@@ -112,19 +118,19 @@ def world_json():
     D = world.WorldDaemon()
     d = {"world_daemon": D.dump_status(dict)}
     d.update(W.list(dict))
-    j = json.dumps(d, default=json_util.default)
+    j = encoders.dumps(d)
     response = Response(response=j, status=200, mimetype="application/json")
     return response
 
 # application junk
 @application.route("/settings.json")
 def get_settings_json():
-    S = settings.Settings()
+    S = settings.get_settings()
     return send_file(S.json_file(), attachment_filename="settings.json", as_attachment=True)
 
 @application.route("/settings")
 def get_settings():
-    S = settings.Settings()
+    S = settings.get_settings()
     return Response(
         response=S.json_file(),
         status=200,
@@ -247,11 +253,12 @@ def new_asset(asset_type):
         return Response(response=json.dumps(output, default=json_util.default), status=200, mimetype="application/json")
 
     request.collection = asset_type
-    request.User = users.token_to_object(request, strict=False)
+    with utils.request_span('auth'):
+        request.User = users.token_to_object(request, strict=False)
     return request_broker.new_user_asset(asset_type)
 
 @application.route("/<collection>/<action>/<asset_id>", methods=["GET","POST","OPTIONS"])
-@utils.crossdomain(origin=['*'],headers=['Content-Type','Authorization','Access-Control-Allow-Origin'])
+@utils.crossdomain(origin=['*'],headers=['Content-Type','Authorization','Access-Control-Allow-Origin','If-None-Match'])
 #@celery.task
 def collection_action(collection, action, asset_id):
     """ This is our major method for retrieving and updating settlements.
@@ -266,12 +273,10 @@ def collection_action(collection, action, asset_id):
     # update the request object
     request.collection = collection
     request.action = action
-    request.User = users.token_to_object(request, strict=False)     # temporarily non-strict
+    with utils.request_span('auth'):
+        request.User = users.token_to_object(request, strict=False)     # temporarily non-strict
 
-    asset_object = request_broker.get_user_asset(collection, asset_id)
-    if type(asset_object) == Response:
-        return asset_object
-    return asset_object.request_response(action)
+    return request_broker.user_asset_request_response(collection, asset_id, action)
 
 
 
@@ -320,19 +325,34 @@ def before_request():
     """ Updates the request with the 'start_time' attrib, which is used for
     performance monitoring. """
     request.start_time = datetime.now()
+    request.event_sink = utils.EventSink()
     request.metering = False
     if socket.getfqdn() != settings.get('api','prod_fqdn'):
         request.metering = True
+    utils.start_request_profile(request)
 
 @application.after_request
 def after_request(response):
-    """ Logs requests. """
+    """ Logs requests; writes settlement events. Adds the Server-Timing header
+    if we're metering or if 'server_timing' is on in settings.cfg. """
+    utils.flush_request_events(request)
+    utils.finish_request_profile(request)
     request.stop_time = datetime.now()
     utils.record_response_time(request)
+    if request.metering or settings.get('api','server_timing'):
+        response.headers['Server-Timing'] = utils.get_server_timing_header(request)
+        response.headers['Timing-Allow-Origin'] = '*'
     if response.status == 500:
         application.logger.error("fail")
     return response
 
+@application.teardown_request
+def teardown_request(exception=None):
+    """ Writes any settlement events that after_request() didn't get to, e.g.
+    because the request blew up; same for the profiler. """
+    utils.flush_request_events(request)
+    utils.finish_request_profile(request)
+
 
 #
 #   special/bogus/meta routes
@@ -9,7 +9,7 @@ general = {
     "api_response_times": {
         "name": "API Request Response Times",
         "max_age": 3,
-        "comment": "Information re: API request response times, including average and max.",
+        "comment": "Information re: API request response times, including average, max, p50/p90/p99 and per-phase percentiles.",
     },
     "dead_survivors": {
         "name": "Dead survivors",
@@ -0,0 +1,72 @@
+#!/usr/bin/python2.7
+
+#
+#   This is the response encoder for the API, i.e. use encoders.dumps() where
+#   you would use json.dumps(..., default=json_util.default).
+#
+#   The output is byte-for-byte the same as json_util's ({"$oid": ...},
+#   {"$date": ...} and all), but it's a lot cheaper for big payloads: the stdlib
+#   C encoder calls default() for every ObjectId and datetime in the payload,
+#   and json_util.default() does a stack of isinstance() checks (and, for
+#   datetimes, a JSONOptions lookup or two) every time. Our default() does one
+#   dict lookup on the object's type and falls back to json_util.default() for
+#   anything it doesn't know.
+#
+#   Register converters for other types with register(), e.g. for an asset
+#   object that knows how to render itself as a dict.
+#
+
+from bson import json_util
+from bson.objectid import ObjectId
+import calendar
+from datetime import datetime
+import json
+
+
+def oid_to_json(oid):
+    return {"$oid": str(oid)}
+
+def datetime_to_json(dt):
+    """ Renders a datetime the way json_util does in its (default) 'legacy'
+    mode, i.e. as milliseconds since the epoch. """
+    if dt.utcoffset() is not None:
+        dt = dt - dt.utcoffset()
+    return {"$date": int(calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond / 1000)}
+
+
+# type -> converter function
+converters = {
+    ObjectId: oid_to_json,
+}
+
+# only use our datetime converter if it does exactly what this version of
+#   json_util does; otherwise, datetimes fall through to json_util.default()
+probe = datetime(2015, 11, 29, 12, 30, 15, 123456)
+if json_util.default(probe) == datetime_to_json(probe):
+    converters[datetime] = datetime_to_json
+
+
+def register(obj_type, converter):
+    """ Registers a 'converter' function, which takes an object of 'obj_type'
+    and returns something JSON serializable. """
+    converters[obj_type] = converter
+
+
+def default(obj):
+    """ The 'default' callback for json.dumps(). """
+    converter = converters.get(type(obj), None)
+    if converter is None:
+        return json_util.default(obj)
+    return converter(obj)
+
+
+# re-using one encoder saves making a new one for every dumps() call
+encoder = json.JSONEncoder(default=default)
+
+def dumps(obj, **kwargs):
+    """ Drop-in replacement for json.dumps(obj, default=json_util.default). Any
+    other json.dumps() kwargs (e.g. 'indent') are passed through. """
+
+    if kwargs:
+        return json.dumps(obj, default=default, **kwargs)
+    return encoder.encode(obj)
@@ -0,0 +1,174 @@
+#!/usr/bin/python2.7
+
+from datetime import datetime
+from optparse import OptionParser
+import sys
+
+import utils
+from Models import AssetConcurrencyError
+from models import settlements, survivors
+
+
+#
+#   This is the offline migration runner for settlement and survivor documents.
+#
+#   Every Settlement and Survivor object has a 'schema_version' class attribute
+#   and a migrate() method that does all of the one-time bug fixes and data
+#   model conversions for that version. When a document gets migrated, its
+#   meta.schema_version gets stamped, and normalize() skips migrate() for it
+#   from then on, i.e. the request path only migrates documents that this
+#   script hasn't gotten to yet.
+#
+#   When you add something to a migrate() method, bump the object's
+#   schema_version and run this script (as the API user) after you deploy.
+#
+#   YHBW
+#
+
+
+def get_outdated_query(schema_version, force=False):
+    """ Returns an MDB query for documents that need to be migrated to
+    'schema_version'. If 'force' is True, it returns everything. """
+
+    if force:
+        return {}
+
+    return {"$or": [
+        {"meta.schema_version": {"$exists": False}},
+        {"meta.schema_version": {"$lt": schema_version}},
+    ]}
+
+
+def iterate_batches(collection, query, batch_size=100):
+    """ Generator that yields lists of document OIDs from 'collection' that
+    match 'query', 'batch_size' OIDs at a time.
+
+    We page on _id (rather than holding a cursor open), so that the documents
+    we're updating can't fall in and out of the result set (or time out the
+    cursor) while we're working. """
+
+    last_id = None
+    while True:
+        page_query = dict(query)
+        if last_id is not None:
+            page_query = {"$and": [query, {"_id": {"$gt": last_id}}]}
+
+        batch = utils.mdb[collection].find(page_query, {"_id": True}).sort("_id", 1).limit(batch_size)
+        batch = [d["_id"] for d in batch]
+        if batch == []:
+            return
+
+        last_id = batch[-1]
+        yield batch
+
+
+class MigrationRunner:
+    """ Initialize one of these with a collection name ('settlements' or
+    'survivors') and call its run() method to migrate every document in that
+    collection that is not at the current schema_version. """
+
+    def __init__(self, collection=None, batch_size=100, force=False, dry_run=False):
+        self.logger = utils.get_logger(log_name="migrations")
+
+        if collection == "settlements":
+            self.model = settlements.Settlement
+        elif collection == "survivors":
+            self.model = survivors.Survivor
+        else:
+            raise ValueError("Cannot migrate the '%s' collection!" % collection)
+
+        self.collection = collection
+        self.batch_size = batch_size
+        self.force = force
+        self.dry_run = dry_run
+        self.performance = {"migrated": 0, "current": 0, "deferred": 0, "failure": 0}
+
+        # survivors need a settlement object; keep the ones we've made
+        self.settlement_objects = {}
+
+
+    def get_settlement_object(self, s_id):
+        """ Returns a (non-normalized) Settlement object for 's_id'. """
+
+        if s_id not in self.settlement_objects:
+            self.settlement_objects[s_id] = settlements.Settlement(_id=s_id, normalize_on_init=False)
+        return self.settlement_objects[s_id]
+
+
+    def migrate_one(self, oid):
+        """ Initializes the object for 'oid' and migrates it (unless it's
+        current). Updates self.performance. """
+
+        if self.collection == "settlements":
+            A = settlements.Settlement(_id=oid, normalize_on_init=False)
+        else:
+            s_id = utils.mdb.survivors.find_one({"_id": oid}, {"settlement": True})["settlement"]
+            A = survivors.Survivor(_id=oid, normalize_on_init=False, Settlement=self.get_settlement_object(s_id))
+
+        if A.schema_is_current() and not self.force:
+            self.performance["current"] += 1
+            return True
+
+        if self.dry_run:
+            self.performance["migrated"] += 1
+            return True
+
+        A.perform_save = False
+        A.migrate()
+        A.save(verbose=False)
+        self.performance["migrated"] += 1
+        return True
+
+
+    def run(self):
+        """ Walks the collection in batches and migrates everything that needs
+        it. Returns self.performance. """
+
+        start = datetime.now()
+        query = get_outdated_query(self.model.schema_version, self.force)
+        total = utils.mdb[self.collection].find(query).count()
+
+        print("\n  Migrating %s %s to schema version %s..." % (total, self.collection, self.model.schema_version))
+        if self.dry_run:
+            print("  Dry run! Nothing will be migrated or saved.")
+        self.logger.info("Migrating %s %s to schema version %s (force=%s, dry_run=%s)" % (total, self.collection, self.model.schema_version, self.force, self.dry_run))
+
+        for batch in iterate_batches(self.collection, query, self.batch_size):
+            for oid in batch:
+                try:
+                    self.migrate_one(oid)
+                except AssetConcurrencyError:
+                    self.performance["deferred"] += 1   # it'll get picked up next time
+                except Exception as e:
+                    self.logger.error("Could not migrate %s '%s'!" % (self.collection, oid))
+                    self.logger.exception(e)
+                    self.performance["failure"] += 1
+            self.settlement_objects = {}
+            print("  %s" % (", ".join(["%s: %s" % (k, self.performance[k]) for k in sorted(self.performance.keys())])))
+
+        print("\n  Finished in %s\n" % (datetime.now() - start))
+        self.logger.info("Finished %s migration in %s. Results: %s" % (self.collection, datetime.now() - start, self.performance))
+        return self.performance
+
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+
+    parser.add_option("--settlements", dest="settlements", action="store_true", default=False, help="Migrate settlement documents.")
+    parser.add_option("--survivors", dest="survivors", action="store_true", default=False, help="Migrate survivor documents.")
+    parser.add_option("--batch_size", dest="batch_size", type="int", default=100, help="Number of documents per batch.", metavar=100)
+    parser.add_option("--dry_run", dest="dry_run", action="store_true", default=False, help="Count outdated documents, but do not migrate them.")
+    parser.add_option("-f", dest="force", action="store_true", default=False, help="Re-migrate ALL documents, including current ones.")
+
+    (options, args) = parser.parse_args()
+
+    if not options.settlements and not options.survivors:
+        parser.print_help()
+        sys.exit(1)
+
+    # do settlements first: survivor migrations look at their settlements
+    if options.settlements:
+        MigrationRunner("settlements", options.batch_size, options.force, options.dry_run).run()
+    if options.survivors:
+        MigrationRunner("survivors", options.batch_size, options.force, options.dry_run).run()
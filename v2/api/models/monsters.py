@@ -52,11 +52,9 @@ class Assets(Models.AssetCollection):
         elif base_class_result is not None:
             return base_class_result
         else:
-            variations = utils.decompose_name_string(name)
-            for v in variations:
-                asset_dict = super(Assets, self).get_asset_from_name(v, raise_exception_if_not_found=False)
-                if asset_dict is not None:
-                    return asset_dict
+            asset_handle = self.get_handle_from_decomposed_name(name)
+            if asset_handle is not None:
+                return self.get_asset(asset_handle)
 
 
 class Monster(Models.GameAsset):
@@ -139,27 +137,18 @@ class Monster(Models.GameAsset):
                 setattr(self, "level", int(i))
 
         # now iterate through the list and see if we can get a name from it
-        for variation in utils.decompose_name_string(self.name):
-            asset_dict = self.assets.get_asset_from_name(variation, decompose=False)
-            if asset_dict is not None:
-                self.initialize_asset(asset_dict)
-#                if len(name_list) > i and name_list[i].upper() not in ["LEVEL","LVL","L"]:
-#                    setattr(self, "comment", (" ".join(name_list[i:])))
-                return True
-
-        # finally, create a list of misspellings and try to get an asset from that
-        #   (this is expensive, so it's a last resort)
-        m_dict = {}
-        for asset_handle in self.assets.get_handles():
-            asset_dict = self.assets.get_asset(asset_handle)
-            if "misspellings" in asset_dict.keys():
-                for m in asset_dict["misspellings"]:
-                    m_dict[m] = asset_handle
+        asset_handle = self.assets.get_handle_from_decomposed_name(self.name)
+        if asset_handle is not None:
+            self.initialize_asset(self.assets.get_asset(asset_handle))
+#            if len(name_list) > i and name_list[i].upper() not in ["LEVEL","LVL","L"]:
+#                setattr(self, "comment", (" ".join(name_list[i:])))
+            return True
 
+        # finally, try the misspellings index (last resort)
         for i in range(len((name_list))+1):
             parsed_name = " ".join(name_list[:i]).upper()
-            if parsed_name in m_dict.keys():
-                asset_handle = m_dict[parsed_name]
+            asset_handle = self.assets.get_handle_from_misspelling(parsed_name)
+            if asset_handle is not None:
                 self.initialize_asset(self.assets.get_asset(asset_handle))
                 if len(name_list) > i and name_list[i].upper() not in ["LEVEL","LVL","L"]:
                     setattr(self, "comment", (" ".join(name_list[i:])))
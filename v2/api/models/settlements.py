@@ -1,19 +1,22 @@
 #!/usr/bin/python2.7
 
 from bson import json_util
-from bson.objectid import ObjectId
+from bson.objectid import ObjectId, InvalidId
 import collections
 from copy import copy
 from datetime import datetime, timedelta
-from flask import Response, request
+from flask import Response, request, stream_with_context
+import hashlib
 import inspect
 import json
 import random
+import threading
 import time
 
 import Models
 import assets
 from models import survivors, campaigns, cursed_items, disorders, gear, endeavors, epithets, expansions, fighting_arts, weapon_specializations, weapon_masteries, causes_of_death, innovations, survival_actions, events, abilities_and_impairments, monsters, milestone_story_events, locations, causes_of_death, names, resources, storage, survivor_special_attributes, weapon_proficiency, survivor_color_schemes
+import encoders
 import settings
 import utils
 
@@ -80,9 +83,23 @@ class Settlement(Models.UserAsset):
     """ This is the base class for all expansions. Private methods exist for
     enabling and disabling expansions (within a campaign/settlement). """
 
+    # process-wide index of compatible asset handles; see get_compatible_handles()
+    compatibility_index = collections.OrderedDict()
+    compatibility_index_max = 2000
+    compatibility_index_lock = threading.Lock()
+
+    # process-wide cache of serialize('game_assets') elements; see get_game_assets()
+    game_assets_cache = collections.OrderedDict()
+    game_assets_cache_max = 500
+    game_assets_cache_lock = threading.Lock()
+
+    # bump this whenever you add something to migrate(); see migrate.py
+    schema_version = 1
+
     def __init__(self, *args, **kwargs):
         self.collection="settlements"
         self.object_version=0.81
+        self._survivors = None
         Models.UserAsset.__init__(self,  *args, **kwargs)
 
         self.init_asset_collections()
@@ -92,14 +109,27 @@ class Settlement(Models.UserAsset):
 
 #        if request.User.get_preference("update_timeline"):
 #            self.update_timeline_with_story_events()
-        if request and request.metering:
-            stop = datetime.now()
-            duration = stop - request.start_time
-            self.logger.debug("%s initialize() -> in %s" % (self, duration))
 
         self.campaign_dict = self.get_campaign(dict)
 
 
+    #
+    #   Survivor objects are expensive, so we don't initialize them until
+    #   something actually asks for self.survivors. Set self.survivors to None
+    #   to throw them away (they get re-initialized on the next access).
+    #
+
+    def _get_survivors_list(self):
+        if self._survivors is None:
+            self.get_survivors('initialize')
+        return self._survivors
+
+    def _set_survivors_list(self, survivors_list):
+        self._survivors = survivors_list
+
+    survivors = property(_get_survivors_list, _set_survivors_list)
+
+
     def init_asset_collections(self):
         """ Generally you want Models.UserAsset.load() to call this method. """
 
@@ -194,6 +224,7 @@ class Settlement(Models.UserAsset):
         #
 
         self._id = utils.mdb.settlements.insert(settlement)
+        utils.record_asset_write('settlements', self._id)
         self.load() # uses self._id
 
         # set the settlement name before we save to MDB
@@ -286,11 +317,40 @@ class Settlement(Models.UserAsset):
         self.log_event(action="apply", key="settlement", value=script["name"], event_type='sysadmin')
 
 
+    @utils.request_span('normalize')
     def normalize(self):
-        """ Makes sure that self.settlement is up to our current standards. """
+        """ Makes sure that self.settlement is up to our current standards.
+
+        Settlements whose meta.schema_version is current skip migrate() (all of
+        the bug fixes and conversions) and only get the cheap, every-load stuff:
+        duck-typing, the founder admin check and minimums. Use migrate.py to
+        migrate all settlements offline. """
 
         self.perform_save = False
 
+        if not self.schema_is_current():
+            self.migrate()
+
+        self.duck_type()
+        self.add_founder_to_admins()
+
+        # enforce minimums
+        self.enforce_minimums()
+
+        # finish
+        if self.perform_save:
+            self.logger.info("%s settlement modified during normalization! Saving changes..." % self)
+            self.save()
+
+
+    def migrate(self):
+        """ Applies all bug fixes, baselines and one-time data model conversions
+        to self.settlement and then stamps it with our current schema_version.
+        Everything in here has to be safe to run more than once.
+
+        Sets self.perform_save, but does NOT save: normalize() and migrate.py do
+        that. """
+
         self.bug_fixes()
         self.baseline()
         self.migrate_settlement_notes()
@@ -346,14 +406,7 @@ class Settlement(Models.UserAsset):
             self.convert_storage()
             self.perform_save = True
 
-
-        # enforce minimums
-        self.enforce_minimums()
-
-        # finish
-        if self.perform_save:
-            self.logger.info("%s settlement modified during normalization! Saving changes..." % self)
-            self.save()
+        self.set_schema_version()
 
 
     def remove(self):
@@ -361,6 +414,7 @@ class Settlement(Models.UserAsset):
         return utils.http_501
 
 
+    @utils.request_span('serialize')
     def serialize(self, return_type=None):
         """ Renders the settlement, including all methods and supplements, as
         a monster JSON object. This is where all views come from."""
@@ -380,120 +434,71 @@ class Settlement(Models.UserAsset):
 
         # retrieve user assets
         if return_type in [None, "sheet",'campaign','survivors']:
-            output.update({"user_assets": {}})
-            output["user_assets"].update({"players": self.get_players()})
-            output["user_assets"].update({"survivors": self.get_survivors()})
+            with utils.request_span('serialize_user_assets'):
+                output.update({"user_assets": {}})
+                output["user_assets"].update({"players": self.get_players()})
+                output["user_assets"].update({"survivors": self.get_survivors()})
 
 
         # create the sheet
         if return_type in [None, 'sheet', 'dashboard', 'campaign']:
-            output.update({"sheet": self.settlement})
-            output["sheet"].update({"campaign": self.campaign.handle})
-            output["sheet"].update({"campaign_pretty": self.campaign.name})
-            output["sheet"].update({"expansions": self.get_expansions()})
-            output["sheet"].update({"expansions_pretty": self.get_expansions(str)})
-            output["sheet"]["settlement_notes"] = self.get_settlement_notes()
-            output["sheet"]["enforce_survival_limit"] = self.get_survival_limit(bool)
-            output["sheet"]["minimum_survival_limit"] = self.get_survival_limit("min")
-            output["sheet"]["minimum_death_count"] = self.get_death_count("min")
-            output["sheet"]["minimum_population"] = self.get_population("min")
-            output['sheet']['population_by_sex'] = self.get_population('sex')
-            output['sheet']['monster_volumes'] = self.get_monster_volumes()
-            output['sheet']['lantern_research_level'] = self.get_lantern_research_level()
-
-            if request.metering:
-                stop = datetime.now()
-                duration = stop - request.start_time
-                self.logger.debug("%s serialize(%s) -> Sheet element in %s" % (self, return_type, duration))
+            with utils.request_span('serialize_sheet'):
+                output.update({"sheet": self.settlement})
+                output["sheet"].update({"campaign": self.campaign.handle})
+                output["sheet"].update({"campaign_pretty": self.campaign.name})
+                output["sheet"].update({"expansions": self.get_expansions()})
+                output["sheet"].update({"expansions_pretty": self.get_expansions(str)})
+                output["sheet"]["settlement_notes"] = self.get_settlement_notes()
+                output["sheet"]["enforce_survival_limit"] = self.get_survival_limit(bool)
+                output["sheet"]["minimum_survival_limit"] = self.get_survival_limit("min")
+                output["sheet"]["minimum_death_count"] = self.get_death_count("min")
+                output["sheet"]["minimum_population"] = self.get_population("min")
+                output['sheet']['population_by_sex'] = self.get_population('sex')
+                output['sheet']['monster_volumes'] = self.get_monster_volumes()
+                output['sheet']['lantern_research_level'] = self.get_lantern_research_level()
 
         # create game_assets
         if return_type in [None, 'game_assets','campaign']:
-            start = datetime.now()
-            output.update({"game_assets": {}})
-            output["game_assets"].update(self.get_available_assets(innovations))
-            output["game_assets"].update(self.get_available_assets(locations, only_include_selectable=True))
-            output["game_assets"].update(self.get_available_assets(abilities_and_impairments))
-            output["game_assets"].update(self.get_available_assets(weapon_specializations))
-            output["game_assets"].update(self.get_available_assets(weapon_masteries))
-            output["game_assets"]['weapon_proficiency_types'] = self.get_available_assets(weapon_proficiency)['weapon_proficiency']
-            output["game_assets"].update(self.get_available_assets(cursed_items))
-            output["game_assets"].update(self.get_available_assets(survival_actions))
-            output["game_assets"].update(self.get_available_assets(events))
-            output["game_assets"].update(self.get_available_assets(monsters))
-            output["game_assets"].update(self.get_available_assets(causes_of_death, handles=False))
-            output["game_assets"].update(self.get_available_assets(epithets))
-            output["game_assets"].update(self.get_available_assets(fighting_arts))
-            output["game_assets"].update(self.get_available_assets(disorders))
-            output['game_assets'].update(self.get_available_assets(endeavors))
-
-            # options (i.e. decks)
-            output["game_assets"]["pulse_discoveries"] = self.get_pulse_discoveries()
-            output["game_assets"]["principles_options"] = self.get_principles_options()
-            output["game_assets"]["milestones_options"] = self.get_milestones_options()
-            output["game_assets"]["milestones_dictionary"] = self.get_milestones_options(dict)
-
-            # monster game assets
-            output["game_assets"]["nemesis_options"] = self.get_monster_options("nemesis_monsters")
-            output["game_assets"]["quarry_options"] = self.get_monster_options("quarries")
-            for c in [
-                "showdown_options",
-                "special_showdown_options",
-                "nemesis_encounters",
-                "defeated_monsters"
-            ]:
-                output["game_assets"][c] = self.get_timeline_monster_event_options(c)
-
-            # meta/other game assets
-            output["game_assets"]["campaign"] = self.campaign.serialize(dict)
-            output["game_assets"]["expansions"] = self.get_expansions(dict)
-
-            # misc helpers for front-end
-            output['game_assets']['survivor_special_attributes'] = self.get_survivor_special_attributes()
-            output["game_assets"]["survival_actions"] = self.get_survival_actions("JSON")
-            output['game_assets']['inspirational_statue_options'] = self.get_available_fighting_arts()
-            output['game_assets']['monster_volumes_options'] = self.get_available_monster_volumes()
-
-            if request.metering:
-                stop = datetime.now()
-                duration = stop - request.start_time
-                self.logger.debug("%s serialize(%s) -> Game Assets element in %s" % (self, return_type, duration))
+            with utils.request_span('serialize_game_assets'):
+                output.update({"game_assets": self.get_game_assets()})
+
+                # these depend on survivors/defeated monsters, so they aren't cached
+                output['game_assets']['inspirational_statue_options'] = self.get_available_fighting_arts()
+                output['game_assets']['monster_volumes_options'] = self.get_available_monster_volumes()
 
         # additional top-level elements for more API "flatness"
         if return_type in ['storage']:
             output['settlement_storage'] = self.get_settlement_storage()
 
         if return_type in [None, 'campaign']:
-            output['survivor_color_schemes'] = self.SurvivorColorSchemes.get_sorted_assets()
-            output["survivor_bonuses"] = self.get_bonuses("JSON")
-            output["survivor_attribute_milestones"] = self.get_survivor_attribute_milestones()
-            output["eligible_parents"] = self.get_eligible_parents()
-            flags = assets.survivor_sheet_options.survivor_status_flags
-            output['survivor_status_flags'] = [{'handle': k, 'name': flags[k]['name']} for k in flags.keys()]
+            with utils.request_span('serialize_survivor_options'):
+                output['survivor_color_schemes'] = self.SurvivorColorSchemes.get_sorted_assets()
+                output["survivor_bonuses"] = self.get_bonuses("JSON")
+                output["survivor_attribute_milestones"] = self.get_survivor_attribute_milestones()
+                output["eligible_parents"] = self.get_eligible_parents()
+                flags = assets.survivor_sheet_options.survivor_status_flags
+                output['survivor_status_flags'] = [{'handle': k, 'name': flags[k]['name']} for k in flags.keys()]
 
 
         # campaign summary specific
         if return_type in ['campaign']:
-            start = datetime.now()
-            output.update({'campaign':{}})
-            output['campaign'].update({'last_five_log_lines': self.get_event_log(lines=5)})
-            output['campaign'].update({'most_recent_milestone': self.get_latest_milestone()})
-            output['campaign'].update({'most_recent_hunt': self.get_latest_defeated_monster()})
-            output['campaign'].update({'latest_death': self.get_latest_survivor('dead')})
-            output['campaign'].update({'latest_birth': self.get_latest_survivor('born')})
-            output['campaign'].update({'special_rules': self.get_special_rules()})
-            output["user_assets"].update({'survivor_groups': self.get_survivors('groups')})
-
-            # endeavors
-            available_endeavors, available_endeavor_count = self.get_available_endeavors()
-            output['campaign'].update({'endeavors': available_endeavors})
-            output['campaign'].update({'endeavor_count': available_endeavor_count})
+            with utils.request_span('serialize_campaign'):
+                output.update({'campaign':{}})
+                output['campaign'].update({'last_five_log_lines': self.get_event_log(lines=5)})
+                output['campaign'].update({'most_recent_milestone': self.get_latest_milestone()})
+                output['campaign'].update({'most_recent_hunt': self.get_latest_defeated_monster()})
+                output['campaign'].update({'latest_death': self.get_latest_survivor('dead')})
+                output['campaign'].update({'latest_birth': self.get_latest_survivor('born')})
+                output['campaign'].update({'special_rules': self.get_special_rules()})
+                output["user_assets"].update({'survivor_groups': self.get_survivors('groups')})
 
-            if request.metering:
-                stop = datetime.now()
-                duration = stop - request.start_time
-                self.logger.debug("%s serialize(%s) -> Campaign element in %s" % (self, return_type, duration))
+                # endeavors
+                available_endeavors, available_endeavor_count = self.get_available_endeavors()
+                output['campaign'].update({'endeavors': available_endeavors})
+                output['campaign'].update({'endeavor_count': available_endeavor_count})
 
-        return json.dumps(output, default=json_util.default)
+        with utils.request_span('json'):
+            return encoders.dumps(output)
 
 
     def unremove(self, unremove_survivors=True):
@@ -527,7 +532,7 @@ class Settlement(Models.UserAsset):
         """Evaluates an asset's dictionary to determine it is compatible for
         use with this settlement. Always returns a bool (no matter what). """
 
-        if type(asset_dict) != dict:
+        if not isinstance(asset_dict, dict):
             asset_dict = asset_dict.__dict__
 
         # check to see if the asset excludes certian campaign types
@@ -541,10 +546,11 @@ class Settlement(Models.UserAsset):
                 return False
 
         # check to see if the campaign forbids the asset
-        if "forbidden" in self.get_campaign(dict):
-            for f_key in self.campaign_dict["forbidden"]:
+        campaign_dict = getattr(self, 'campaign_dict', None) or self.get_campaign(dict)
+        if "forbidden" in campaign_dict:
+            for f_key in campaign_dict["forbidden"]:
                 if asset_dict.get("type", None) == f_key:
-                    if asset_dict["handle"] in self.campaign_dict["forbidden"][f_key]:
+                    if asset_dict["handle"] in campaign_dict["forbidden"][f_key]:
                         return False
 
         return True
@@ -663,7 +669,7 @@ class Settlement(Models.UserAsset):
             ly = last_year_in_tl + 1 + y
             self.settlement['timeline'].append({'year': ly})
 
-        self.log_event(action="add", key="Timeline", value="%s Lantern Years" % years)
+        self.log_event(action="add", key="Timeline", value="%s Lantern Years" % years, event_type="add_lantern_years")
         self.save()
 
 
@@ -686,7 +692,7 @@ class Settlement(Models.UserAsset):
             else:
                 self.logger.warn("Refusing to remove LY %s (which has events)." % (self.settlement['timeline'][-1]['year']))
 
-        self.log_event(action="rm", key="Timeline", value="%s Lantern Years" % lys_removed)
+        self.log_event(action="rm", key="Timeline", value="%s Lantern Years" % lys_removed, event_type="rm_lantern_years")
         self.save()
 
 
@@ -818,7 +824,7 @@ class Settlement(Models.UserAsset):
         #
         for e_handle in e_list:
             e_dict = self.Expansions.get_asset(e_handle)
-            self.log_event(action="adding", key="expansions", value=e_dict['name'])
+            self.log_event(action="adding", key="expansions", value=e_dict['name'], event_type="add_expansions")
 
             self.settlement["expansions"].append(e_handle)
 
@@ -862,7 +868,7 @@ class Settlement(Models.UserAsset):
         #
         for e_handle in e_list:
             e_dict = self.Expansions.get_asset(e_handle)
-            self.log_event(action="removing", key="expansions", value=e_dict['name'])
+            self.log_event(action="removing", key="expansions", value=e_dict['name'], event_type="rm_expansions")
 
             self.settlement["expansions"].remove(e_handle)
 
@@ -1110,7 +1116,7 @@ class Settlement(Models.UserAsset):
             raise utils.InvalidUsage("The email address '%s' does not belong to a registered user!" % user_login, status_code=400)
 
         self.settlement['admins'].append(user_login)
-        self.log_event(action="add", key="administrators", value=user_login)
+        self.log_event(action="add", key="administrators", value=user_login, event_type="add_settlement_admin")
         self.save()
 
 
@@ -1131,7 +1137,7 @@ class Settlement(Models.UserAsset):
             raise utils.InvalidUsage("The email address '%s' does not belong to a registered user!" % user_login, status_code=400)
 
         self.settlement['admins'].remove(user_login)
-        self.log_event(action="rm", key="administrators", value=user_login)
+        self.log_event(action="rm", key="administrators", value=user_login, event_type="rm_settlement_admin")
         self.save()
 
 
@@ -1153,6 +1159,7 @@ class Settlement(Models.UserAsset):
         }
 
         note_oid = utils.mdb.settlement_notes.insert(note_dict)
+        utils.touch_settlements([self.settlement['_id']])
 #        self.logger.debug("[%s] added a settlement note to %s" % (author_email, self))
         return Response(response=json.dumps({'note_oid': note_oid}, default=json_util.default), status=200)
 
@@ -1167,6 +1174,7 @@ class Settlement(Models.UserAsset):
         n_id = ObjectId(n_id)
 
         n = utils.mdb.settlement_notes.remove({"settlement": self.settlement["_id"], "_id": n_id})
+        utils.touch_settlements([self.settlement['_id']])
 #        self.logger.debug(n)
         self.logger.info("%s User '%s' removed a settlement note" % (self, request.User.login))
 
@@ -1410,7 +1418,7 @@ class Settlement(Models.UserAsset):
 
         self.settlement['lantern_year'] = ly
 
-        self.log_event(action='set', key="current Lantern Year", value=ly)
+        self.log_event(action='set', key="current Lantern Year", value=ly, event_type="set_current_ly")
         self.save()
 
 
@@ -1427,7 +1435,7 @@ class Settlement(Models.UserAsset):
             raise utils.InvalidUsage("Fighting Art handle '%s' is not a known asset handle!" % (fa_handle))
 
         self.settlement['inspirational_statue'] = fa_handle
-        self.log_event(action="set", key="Inspirational Statue", value=fa_dict['name'])
+        self.log_event(action="set", key="Inspirational Statue", value=fa_dict['name'], event_type="set_inspirational_statue")
         self.save()
 
 
@@ -1440,7 +1448,7 @@ class Settlement(Models.UserAsset):
 
         # create the attrib if it doesn't exist
         self.settlement['lantern_research_level'] = level
-        self.log_event(action="set", key="Lantern Research level", value=level)
+        self.log_event(action="set", key="Lantern Research level", value=level, event_type="set_lantern_research_level")
         self.save()
 
 
@@ -1478,7 +1486,7 @@ class Settlement(Models.UserAsset):
         else:
             self.settlement["lost_settlements"] = int(new_value)
 
-        self.log_event(action="set", key="Lost Settlements count", value=new_value)
+        self.log_event(action="set", key="Lost Settlements count", value=new_value, event_type="set_lost_settlements")
         self.save()
 
 
@@ -1503,7 +1511,7 @@ class Settlement(Models.UserAsset):
         else:
             msg = "%s changed settlement name from '%s' to '%s'" % (request.User.login, old_name, new_name)
 
-        self.log_event(action="set", key="name", value=new_name)
+        self.log_event(action="set", key="name", value=new_name, event_type="set_name")
         self.save()
 
 
@@ -1579,7 +1587,7 @@ class Settlement(Models.UserAsset):
 
         # finally, add the little fucker
         self.settlement["principles"].append(e_dict["handle"])
-        self.log_event(action="set", key="'%s' principle" % p_dict['name'], value=e_dict['name'])
+        self.log_event(action="set", key="'%s' principle" % p_dict['name'], value=e_dict['name'], event_type="set_principle")
 
         # if we're still here, go ahead and save since we probably updated
         self.save()
@@ -1976,6 +1984,131 @@ class Settlement(Models.UserAsset):
     #
 
 
+    def get_game_assets(self):
+        """ Returns the 'game_assets' element of the settlement's serialize()
+        output, minus the bits that depend on survivors, etc. (those get added
+        by serialize() itself).
+
+        This is the heaviest part of a settlement's serialized representation
+        and it only depends on a few attributes of the settlement (see
+        get_game_assets_key() below), so it gets cached in a process-wide
+        dict (Settlement.game_assets_cache) and served from memory when another
+        request for a settlement with the same key comes along. The cache is
+        LRU, i.e. entries for keys nobody uses any more age out.
+
+        serialize() only adds top-level keys to the dict this returns, so cache
+        hits get a shallow copy: don't modify anything below the top level!
+
+        API workers are threaded, so the cache is only touched with
+        Settlement.game_assets_cache_lock held (but not while we build a new
+        entry: two threads might both build one, which is harmless).
+        """
+
+        key = self.get_game_assets_key()
+        with Settlement.game_assets_cache_lock:
+            cached = Settlement.game_assets_cache.pop(key, None)
+            if cached is not None:
+                Settlement.game_assets_cache[key] = cached     # i.e. most recently used
+                return dict(cached)
+
+        game_assets = {}
+        game_assets.update(self.get_available_assets(innovations))
+        game_assets.update(self.get_available_assets(locations, only_include_selectable=True))
+        game_assets.update(self.get_available_assets(abilities_and_impairments))
+        game_assets.update(self.get_available_assets(weapon_specializations))
+        game_assets.update(self.get_available_assets(weapon_masteries))
+        game_assets['weapon_proficiency_types'] = self.get_available_assets(weapon_proficiency)['weapon_proficiency']
+        game_assets.update(self.get_available_assets(cursed_items))
+        game_assets.update(self.get_available_assets(survival_actions))
+        game_assets.update(self.get_available_assets(events))
+        game_assets.update(self.get_available_assets(monsters))
+        game_assets.update(self.get_available_assets(causes_of_death, handles=False))
+        game_assets.update(self.get_available_assets(epithets))
+        game_assets.update(self.get_available_assets(fighting_arts))
+        game_assets.update(self.get_available_assets(disorders))
+        game_assets.update(self.get_available_assets(endeavors))
+
+        # options (i.e. decks)
+        game_assets["pulse_discoveries"] = self.get_pulse_discoveries()
+        game_assets["principles_options"] = self.get_principles_options()
+        game_assets["milestones_options"] = self.get_milestones_options()
+        game_assets["milestones_dictionary"] = self.get_milestones_options(dict)
+
+        # monster game assets
+        game_assets["nemesis_options"] = self.get_monster_options("nemesis_monsters")
+        game_assets["quarry_options"] = self.get_monster_options("quarries")
+        for c in [
+            "showdown_options",
+            "special_showdown_options",
+            "nemesis_encounters",
+            "defeated_monsters"
+        ]:
+            game_assets[c] = self.get_timeline_monster_event_options(c)
+
+        # meta/other game assets
+        game_assets["campaign"] = self.campaign.serialize(dict)
+        game_assets["expansions"] = self.get_expansions(dict)
+
+        # misc helpers for front-end
+        game_assets['survivor_special_attributes'] = self.get_survivor_special_attributes()
+        game_assets["survival_actions"] = self.get_survival_actions("JSON")
+
+        with Settlement.game_assets_cache_lock:
+            Settlement.game_assets_cache[key] = dict(game_assets)
+            while len(Settlement.game_assets_cache) > Settlement.game_assets_cache_max:
+                Settlement.game_assets_cache.popitem(last=False)
+
+        return game_assets
+
+
+    def get_game_assets_key(self):
+        """ Returns a hash of the settlement attributes that determine the
+        output of get_game_assets(). """
+
+        fingerprint = {}
+        for k in ['campaign','expansions','innovations','principles','quarries','nemesis_monsters']:
+            fingerprint[k] = self.settlement.get(k, None)
+        fingerprint = json.dumps(fingerprint, sort_keys=True, default=json_util.default)
+
+        return hashlib.md5(fingerprint).hexdigest()
+
+
+    def get_compatible_handles(self, asset_module=None):
+        """ Returns a tuple of the handles (in AssetCollection.get_handles()
+        order) of all assets in 'asset_module' that pass self.is_compatible().
+
+        Compatibility only depends on the settlement's campaign and expansions
+        (the asset catalog itself is loaded once per process), so the results
+        are kept in a process-wide index (Settlement.compatibility_index) keyed
+        on those things and re-used by every settlement that has the same
+        campaign and expansions. Like the game assets cache, the index is LRU,
+        never holds more than Settlement.compatibility_index_max keys and is
+        only touched with its lock held.
+        """
+
+        key = (
+            asset_module.__name__,
+            self.campaign.handle,
+            tuple(sorted(self.get_expansions())),
+        )
+
+        with Settlement.compatibility_index_lock:
+            compatible = Settlement.compatibility_index.pop(key, None)
+            if compatible is not None:
+                Settlement.compatibility_index[key] = compatible     # i.e. most recently used
+                return compatible
+
+        A = asset_module.Assets()
+        compatible = tuple([h for h in A.get_handles() if self.is_compatible(A.assets[h])])
+
+        with Settlement.compatibility_index_lock:
+            Settlement.compatibility_index[key] = compatible
+            while len(Settlement.compatibility_index) > Settlement.compatibility_index_max:
+                Settlement.compatibility_index.popitem(last=False)
+
+        return compatible
+
+
     def get_available_assets(self, asset_module=None, handles=True, exclude_types=[], only_include_selectable=False):
         """ Generic function to return a dict of available game assets based on
         their family. The 'asset_module' should be something such as,
@@ -1994,24 +2127,22 @@ class Settlement(Models.UserAsset):
         else:
             available = []
 
-        A = copy(asset_module.Assets())
-
-        # remove excluded type/sub_types
-        if exclude_types != []:
-            A.filter("type", exclude_types)
-            A.filter("sub_type", exclude_types)
+        A = asset_module.Assets()
 
-        if only_include_selectable:
-            A.filter('selectable', [False])
+        # update available; excluded type/sub_types and unselectable assets get
+        #   skipped the same way that AssetCollection.filter() would drop them
+        for n in self.get_compatible_handles(asset_module):
+            raw_dict = A.assets[n]
+            if exclude_types != [] and (raw_dict.get('type', None) in exclude_types or raw_dict.get('sub_type', None) in exclude_types):
+                continue
+            if only_include_selectable and raw_dict.get('selectable', None) in [False]:
+                continue
 
-        # update available
-        for n in A.get_handles():
             asset_dict = A.get_asset(n)
-            if self.is_compatible(asset_dict):
-                if handles: # return a dict
-                    available.update({asset_dict["handle"]: asset_dict})
-                else:       # return a list of dicts
-                    available.append(asset_dict)
+            if handles: # return a dict
+                available.update({asset_dict["handle"]: asset_dict})
+            else:       # return a list of dicts
+                available.append(asset_dict)
 
         # REMOVE THIS
         if type(available) == list: #list of dicts; needs sorting
@@ -2221,8 +2352,8 @@ class Settlement(Models.UserAsset):
 
         if return_type == "min":
             min_death_count = 0
-            for s in self.survivors:
-                if s.is_dead():
+            for s in self.get_survivor_summaries(['dead']):
+                if 'dead' in s:
                     min_death_count += 1
             return min_death_count
 
@@ -2273,14 +2404,46 @@ class Settlement(Models.UserAsset):
         return s_expansions
 
 
-    def get_event_log(self, return_type=None, ly=None, lines=None, get_lines_after=None, survivor_id=None):
-        """ Returns the settlement's event log as a cursor object unless told to
-        do otherwise.
-        
-        Checks for a request and, if one exists, tries to search for lines after
-        a certain time.
+    def get_event_log(self, return_type=None, ly=None, lines=None, get_lines_after=None, survivor_id=None, after=None, before=None, limit=None):
+        """ Returns the settlement's event log (latest first) as a list unless
+        told to do otherwise.
+
+        Checks for a request and, if one exists, gets its params.
+
+        If the request (or the caller) uses a cursor, i.e. 'after', 'before' or
+        'limit', we return a page of events rather than a list:
+
+            {
+                'events': [...],            # latest first, up to 'limit'
+                'after': <cursor>,          # use this to get newer lines
+                'before': <cursor>,         # use this to get older lines
+                'has_more': bool,           # more lines past this page?
+            }
+
+        'after' gets the oldest 'limit' lines newer than the cursor (i.e. poll
+        with the latest 'after' cursor and you've got a feed); 'before' gets the
+        newest 'limit' lines older than it. Cursors are opaque tokens: see
+        utils.get_cursor(). Pages are settings.api.event_log_page_size lines,
+        by default, and never more than settings.api.event_log_max_lines.
+
+        Old-style calls (i.e. 'lines', 'ly' and 'get_lines_after') still get a
+        list, but it's capped at settings.api.event_log_max_lines lines.
+
+        Params that aren't ints or OIDs (as the case may be) get a 400.
         """
 
+        def get_int(param, v):
+            try:
+                return int(v)
+            except (TypeError, ValueError):
+                raise utils.InvalidUsage("'%s' must be an int, not '%s'!" % (param, v), status_code=400)
+
+        def get_oid(param, v):
+            try:
+                return ObjectId(v)
+            except (InvalidId, TypeError):
+                raise utils.InvalidUsage("'%s' must be an OID, not '%s'!" % (param, v), status_code=400)
+
         if request and hasattr(self, 'params'):
             if 'lines' in self.params:
                 lines = self.params['lines']
@@ -2290,33 +2453,167 @@ class Settlement(Models.UserAsset):
                 survivor_id = self.params['survivor_id']
             if 'ly' in self.params:
                 ly = self.params['ly']
+            after = self.params.get('after', after)
+            before = self.params.get('before', before)
+            limit = self.params.get('limit', limit)
+
+        # write anything this request has logged, so it shows up in the log
+        if request:
+            utils.flush_request_events(request, force=True)
+
+        max_lines = settings.get_int('api', 'event_log_max_lines')
 
-        query = {"settlement_id": self.settlement["_id"]}
+        if survivor_id is not None:
+            field, value = 'survivor_id', get_oid('survivor_id', survivor_id)
+        else:
+            field, value = 'settlement_id', self.settlement['_id']
+
+        #
+        #   cursor-based pages
+        #
+
+        if after is not None or before is not None or limit is not None:
+            if limit is None:
+                limit = settings.get_int('api', 'event_log_page_size')
+            limit = max(1, min(get_int('limit', limit), max_lines))
+
+            # pages stop at the feed horizon, so the cursors we hand out never
+            #   skip lines that are still being written
+            horizon = utils.get_feed_horizon()
+            if after is not None:
+                query = utils.get_cursor_query(field, value, after, 'after', horizon)
+                sort = 1
+            elif before is not None:
+                query = utils.get_cursor_query(field, value, before, 'before', horizon)
+                sort = -1
+            else:
+                query = utils.get_cursor_query(field, value, horizon=horizon)
+                sort = -1
+
+            events = list(utils.mdb.settlement_events.find(query).sort([('created_on', sort), ('_id', sort)]).limit(limit + 1))
+            has_more = len(events) > limit
+            events = events[:limit]
+            if sort == 1:
+                events.reverse()
+
+            page = {
+                'events': events,
+                'after': utils.get_cursor(events[0]) if events != [] else after,
+                'before': utils.get_cursor(events[-1]) if events != [] else before,
+                'has_more': has_more,
+            }
+
+            if return_type == "JSON":
+                return encoders.dumps(page)
+            return page
+
+        #
+        #   old-style lists
+        #
+
+        query = {field: value}
 
         # modify the query, if we're doing that
         if get_lines_after is not None and ly is None:
-            target_line = utils.mdb.settlement_events.find_one({'_id': ObjectId(get_lines_after)})
+            target_line = utils.mdb.settlement_events.find_one({'_id': get_oid('get_lines_after', get_lines_after)})
+            if target_line is None:
+                raise utils.InvalidUsage("'%s' is not a settlement event!" % get_lines_after, status_code=400)
             query.update({"created_on": {'$gt': target_line['created_on']}})
         elif ly is not None and get_lines_after is None:
-            query.update({'ly': int(ly)})
-
-        if survivor_id is not None:
-            query = {'survivor_id': ObjectId(survivor_id)}
+            query.update({'ly': get_int('ly', ly)})
 
         # now do the query
-        event_log = utils.mdb.settlement_events.find(query).sort("created_on",-1)
+        event_log = utils.mdb.settlement_events.find(query).sort([('created_on', -1), ('_id', -1)])
 
         # limit, if we're doing that
-        if lines is not None:
-            event_log.limit(lines)
+        if lines is None or get_int('lines', lines) > max_lines:
+            lines = max_lines
+        event_log.limit(get_int('lines', lines))
 
         # process 'return_type' and wrap up
         if return_type=="JSON":
-            return json.dumps(list(event_log),default=json_util.default)
+            return encoders.dumps(list(event_log))
 
         return list(event_log)
 
 
+    def stream_event_log(self, after=None):
+        """ Returns a server-sent events (i.e. 'text/event-stream') response
+        that pushes new settlement event log lines to the client as they get
+        written, i.e. so that clients don't have to poll get_event_log().
+
+        Each line is one 'settlement_event' type SSE event whose 'id' is the
+        line's cursor (see get_event_log()) and whose 'data' is the line as
+        JSON. Streams start after the latest line, unless the request has an
+        'after' cursor param or a 'Last-Event-ID' header (which EventSource
+        clients send automatically when they reconnect).
+
+        We get woken up by utils.event_broker when this process writes an event
+        for the settlement; we also check for new lines every
+        settings.api.event_stream_poll_interval seconds, which picks up lines
+        written by other processes.
+
+        An open stream ties up a gunicorn worker thread (see install.sh: we run
+        'gthread' workers so that it's a thread and not the whole worker, which
+        is why the process-wide caches have locks), so
+        streams close after settings.api.event_stream_max_age seconds, which
+        has to be less than gunicorn's worker timeout (30s, by default), and
+        the client reconnects. Each process only does
+        settings.api.event_stream_max_streams streams at a time: past that,
+        clients get a 503 and should fall back to polling get_event_log().
+        """
+
+        if utils.event_broker.get_subscription_count() >= settings.get_int('api', 'event_stream_max_streams'):
+            response = Response(response="Too many open event log streams! Poll get_event_log instead.", status=503)
+            response.headers['Retry-After'] = str(settings.get_int('api', 'event_stream_poll_interval'))
+            return response
+
+        if request and hasattr(self, 'params'):
+            after = self.params.get('after', after)
+        if request and request.headers.get('Last-Event-ID', None) is not None:
+            after = request.headers['Last-Event-ID']
+
+        settlement_id = self.settlement['_id']
+        if after is None:
+            query = utils.get_cursor_query('settlement_id', settlement_id, horizon=utils.get_feed_horizon())
+            latest = utils.mdb.settlement_events.find_one(query, {'created_on': 1}, sort=[('created_on', -1), ('_id', -1)])
+            if latest is not None:
+                after = utils.get_cursor(latest)
+        else:
+            utils.parse_cursor(after)   # bad cursors are 400s, not broken streams
+
+        poll_interval = settings.get_int('api', 'event_stream_poll_interval')
+        max_age = settings.get_int('api', 'event_stream_max_age')
+        page_size = settings.get_int('api', 'event_log_page_size')
+        lag = settings.get_float('api', 'event_feed_lag')
+
+        def stream(after):
+            subscription = utils.event_broker.subscribe(settlement_id)
+            stop_at = time.time() + max_age
+            try:
+                yield "retry: %s\n\n" % (poll_interval * 1000)
+                while time.time() < stop_at:
+                    subscription.clear()
+                    query = utils.get_cursor_query('settlement_id', settlement_id, after, 'after', utils.get_feed_horizon())
+                    lines = list(utils.mdb.settlement_events.find(query).sort([('created_on', 1), ('_id', 1)]).limit(page_size))
+                    for line in lines:
+                        after = utils.get_cursor(line)
+                        yield "id: %s\nevent: settlement_event\ndata: %s\n\n" % (after, encoders.dumps(line))
+                    if len(lines) == page_size:
+                        continue
+                    if subscription.wait(poll_interval):
+                        time.sleep(lag)     # i.e. until the new lines are behind the horizon
+                    else:
+                        yield ": keep-alive\n\n"
+            finally:
+                utils.event_broker.unsubscribe(settlement_id, subscription)
+
+        response = Response(stream_with_context(stream(after)), status=200, mimetype="text/event-stream")
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'    # i.e. tell nginx not to buffer it
+        return response
+
+
     def get_eligible_parents(self):
         """ Returns a dictionary with two lists of survivors who are able to do
         the mommy-daddy dance: one for male survivors and one for female
@@ -2585,15 +2882,23 @@ class Settlement(Models.UserAsset):
 
         if return_type == "min":
             min_pop = 0
-            for s in self.survivors:
-                if not s.is_dead():
+            for s in self.get_survivor_summaries(['dead']):
+                if not 'dead' in s:
                     min_pop += 1
             return min_pop
         elif return_type == 'sex':
+            # same math as Survivor.get_sex(), minus the Survivor objects
+            AI = abilities_and_impairments.Assets()
             output = {'M':0, 'F':0}
-            for s in self.survivors:
-                if not s.is_dead():
-                    output[s.get_sex()] += 1
+            for s in self.get_survivor_summaries(['dead', 'sex', 'abilities_and_impairments']):
+                if 'dead' in s:
+                    continue
+                sex = s['sex']
+                for ai in s.get('abilities_and_impairments', []):
+                    ai_dict = AI.get_asset(ai, backoff_to_name=True, raise_exception_if_not_found=False)
+                    if ai_dict is not None and ai_dict.get('reverse_sex', False):
+                        sex = {'M': 'F', 'F': 'M'}.get(sex, sex)
+                output[sex] += 1
             return output
 
         return int(self.settlement["population"])
@@ -2753,6 +3058,32 @@ class Settlement(Models.UserAsset):
         return output
 
 
+    def get_survivor_summaries(self, fields=[]):
+        """ Returns a list of survivor 'summary' dictionaries: each dict has the
+        survivor's '_id' plus whichever of the keys in the 'fields' kwarg the
+        survivor's MDB document actually has.
+
+        This is the cheap way to get at survivor info when you don't need to
+        call Survivor object methods: if the settlement's survivors have already
+        been initialized, the summaries are made from them; otherwise, we do a
+        single, projected query and do NOT initialize any Survivor objects. """
+
+        if self._survivors is not None:
+            output = []
+            for S in self._survivors:
+                s_dict = {'_id': S.survivor['_id']}
+                for k in fields:
+                    if k in S.survivor:
+                        s_dict[k] = S.survivor[k]
+                output.append(s_dict)
+            return output
+
+        query = {"settlement": self.settlement["_id"], "removed": {"$exists": False}}
+        projection = dict([(k, True) for k in fields])
+        projection['_id'] = True
+        return list(utils.mdb.survivors.find(query, projection).sort('name'))
+
+
     def get_survivors(self, return_type=None, excluded=[], exclude_dead=False):
         """ This method is the ONE AND ONLY exception to the Settlement Object
         rule about never initializing survivors. This is the ONE AND ONLY place
@@ -2791,9 +3122,10 @@ class Settlement(Models.UserAsset):
 
             all_survivors = utils.mdb.survivors.find(query).sort('name')
             for s in all_survivors:
-                # init the survivor
-                S = survivors.Survivor(_id=s["_id"], Settlement=self, normalize_on_init=False)
-                S.bug_fixes(force_save=True)
+                # init the survivor (from the doc we've already got)
+                S = survivors.Survivor(_id=s["_id"], mdb_doc=s, Settlement=self, normalize_on_init=False)
+                if not S.schema_is_current():
+                    S.bug_fixes(force_save=True)
                 self.survivors.append(S)
 #            self.logger.debug("%s Initialized %s survivors!" % (self, len(self.survivors)))
             return True
@@ -3222,8 +3554,8 @@ class Settlement(Models.UserAsset):
         set of players. """
 
         player_set = set()
-        for s in self.survivors:
-            player_set.add(s.survivor["email"])
+        for s in self.get_survivor_summaries(['email']):
+            player_set.add(s["email"])
 
         player_set = utils.mdb.users.find({"login": {"$in": list(player_set)}})
 
@@ -3303,19 +3635,26 @@ class Settlement(Models.UserAsset):
             self.settlement["custom_epithets"] = []
             self.perform_save = True
 
-        founder = self.get_founder()
-        if not founder["login"] in self.settlement["admins"]:
-            self.settlement["admins"].append(founder["login"])
-            self.logger.debug("Adding founder '%s' to %s admins list." % (founder["login"], self))
-            self.perform_save = True
-
         if not "expansions" in self.settlement.keys():
             self.logger.info("Creating 'expansions' key for %s" % (self))
             self.settlement["expansions"] = []
             self.perform_save = True
 
 
-        # Duck Typing!
+    def add_founder_to_admins(self):
+        """ Makes sure that the settlement's founder is in its 'admins' list.
+        This runs on every load (see normalize()). """
+
+        founder = self.get_founder()
+        if not founder["login"] in self.settlement.get("admins", []):
+            self.settlement.setdefault("admins", []).append(founder["login"])
+            self.logger.debug("Adding founder '%s' to %s admins list." % (founder["login"], self))
+            self.perform_save = True
+
+
+    def duck_type(self):
+        """ Duck-types settlement attributes that bad form input, etc. can leave
+        as strings. This runs on every load (see normalize()). """
 
         for attrib in ['survival_limit', 'population', 'death_count']:
             self.settlement[attrib] = int(self.settlement[attrib])
@@ -3828,6 +4167,8 @@ class Settlement(Models.UserAsset):
             return Response(response=self.get_settlement_storage(), status=200, mimetype="application/json")
         elif action == "get_event_log":
             return Response(response=self.get_event_log("JSON"), status=200, mimetype="application/json")
+        elif action == "stream_event_log":
+            return self.stream_event_log()
         elif action == "get_innovation_deck":
             return Response(response=self.get_innovation_deck(), status=200, mimetype="application/json")
         elif action == "get_timeline":
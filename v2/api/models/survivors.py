@@ -14,6 +14,7 @@ import math
 from PIL import Image
 import random
 
+import encoders
 import Models
 import settings
 import utils
@@ -106,6 +107,9 @@ class Survivor(Models.UserAsset):
         return "%s [%s] (%s)" % (self.survivor["name"], self.survivor["sex"], self.survivor["_id"])
 
 
+    # bump this whenever you add something to migrate(); see migrate.py
+    schema_version = 1
+
     def __init__(self, *args, **kwargs):
         self.collection="survivors"
         self.object_version = 0.87
@@ -317,6 +321,8 @@ class Survivor(Models.UserAsset):
         # 1. insert the record we've been developing and call the base class
         #   load() method, which will initialize and let us use class methods
         self._id = utils.mdb.survivors.insert(self.survivor)
+        utils.record_asset_write('survivors', self._id)
+        utils.touch_settlements([self.survivor['settlement']])
         self.load()
 
         # 2. set the name
@@ -379,7 +385,7 @@ class Survivor(Models.UserAsset):
 
             if buff_list != []:
                 buff_string = utils.list_to_pretty_string(buff_sources)
-                self.log_event(action='apply', key=self.pretty_name(), value='%s bonuses' % buff_string)
+                self.log_event(action='apply', key=self.pretty_name(), value='%s bonuses' % buff_string, event_type="new")
                 apply_buff_list(buff_list)
         else:
             self.log_event("Settlement bonuses where not applied to %s due to user preference." % self.pretty_name())
@@ -494,15 +500,48 @@ class Survivor(Models.UserAsset):
         return True
 
 
+    @utils.request_span('normalize')
     def normalize(self):
         """ In which we force the survivor's mdb document to adhere to the biz
         logic of the game and our own data model. """
 
         self.perform_save = False
 
+        if not self.schema_is_current():
+            self.migrate()
+
+        self.duck_type()
+
+        #
+        #   user asset normalization
+        #
+
+        if self.survivor['name'] != utils.html_stripper(self.survivor['name']):
+            self.survivor['name'] = utils.html_stripper(self.survivor['name'])
+            self.perform_save = True
+
+        # handle orphan partners
+        if self.survivor.get('partner_id', None) is not None:
+            partner = utils.mdb.survivors.find_one({'_id': self.survivor['partner_id']})
+            if partner.get('partner_id', None) != self.survivor['_id']:
+                self.set_partner("UNSET")
+
+        # enforce minimum attributes for certain attribs
+        self.min_attributes()
+
+        if self.perform_save:
+            self.logger.info("%s survivor modified during normalization! Saving changes..." % self)
+            self.save()
+
+
+    def migrate(self):
+        """ Applies bug fixes, baselines and one-time data model conversions to
+        self.survivor and stamps it with our current schema_version. Like the
+        Settlement version of this method, everything in here has to be safe to
+        run more than once, and it does NOT save. """
+
         self.bug_fixes()
         self.baseline()
-        self.duck_type()
 
         #
         #   asset migrations (names to handles)
@@ -537,14 +576,6 @@ class Survivor(Models.UserAsset):
             self.perform_save = True
 
 
-        #
-        #   user asset normalization
-        #
-
-        if self.survivor['name'] != utils.html_stripper(self.survivor['name']):
-            self.survivor['name'] = utils.html_stripper(self.survivor['name'])
-            self.perform_save = True
-
         #
         #   game asset normalization - TKTK fix this up
         #
@@ -554,25 +585,15 @@ class Survivor(Models.UserAsset):
             self.logger.debug("%s Removing deprecated attribute 'ability_customizations'." % self)
             self.perform_save = True
 
-        # handle orphan partners
-        if self.survivor.get('partner_id', None) is not None:
-            partner = utils.mdb.survivors.find_one({'_id': self.survivor['partner_id']})
-            if partner.get('partner_id', None) != self.survivor['_id']:
-                self.set_partner("UNSET")
-
         # add the savior key if we're dealing with a savior
         if self.is_savior() and not "savior" in self.survivor.keys():
             self.survivor["savior"] = self.is_savior()
             self.perform_save
 
-        # enforce minimum attributes for certain attribs
-        self.min_attributes()
-
-        if self.perform_save:
-            self.logger.info("%s survivor modified during normalization! Saving changes..." % self)
-            self.save()
+        self.set_schema_version()
 
 
+    @utils.request_span('serialize')
     def serialize(self, return_type=None, include_meta=True):
         """ Renders the survivor as JSON. We don't serialize to anything else."""
 
@@ -619,7 +640,8 @@ class Survivor(Models.UserAsset):
         if return_type == dict:
             return output
 
-        return json.dumps(output, default=json_util.default)
+        with utils.request_span('json'):
+            return encoders.dumps(output)
 
 
     def unremove(self):
@@ -885,7 +907,7 @@ class Survivor(Models.UserAsset):
         self.survivor[asset_class].append(asset_dict["handle"])
         self.survivor[asset_class].sort()
         if log_event:
-            self.log_event(action="add", key=asset_class, value=asset_dict['name'])
+            self.log_event(action="add", key=asset_class, value=asset_dict['name'], event_type="add_game_asset")
 
 
         #
@@ -1269,7 +1291,7 @@ class Survivor(Models.UserAsset):
 
         # finally, if we're still here, add it and log_event() it
         self.survivor[asset_class].remove(asset_dict["handle"])
-        self.log_event(action="rm", key=asset_class, value=asset_dict['name'])
+        self.log_event(action="rm", key=asset_class, value=asset_dict['name'], event_type="rm_game_asset")
 
         if save:
             self.save()
@@ -1290,7 +1312,8 @@ class Survivor(Models.UserAsset):
         }
 
         note_oid = utils.mdb.survivor_notes.insert(note_dict)
-        self.log_event(action="add", key="notes", value="a note")
+        utils.touch_settlements([note_dict['settlement_id']])
+        self.log_event(action="add", key="notes", value="a note", event_type="add_note")
 
         return Response(response=json.dumps({'note_oid': note_oid}, default=json_util.default), status=200)
 
@@ -1302,6 +1325,7 @@ class Survivor(Models.UserAsset):
         _id = ObjectId(self.params['_id'])
 
         utils.mdb.survivor_notes.remove({'_id': _id})
+        utils.touch_settlements([self.survivor['settlement']])
 #        self.logger.debug("%s Removed a note from %s" % (request.User, self))
 
 
@@ -1441,7 +1465,7 @@ class Survivor(Models.UserAsset):
             modifier = int(self.params["modifier"])
 
         self.survivor["survival"] += modifier
-        self.log_event(action="add", key="Survival", value=modifier)
+        self.log_event(action="add", key="Survival", value=modifier, event_type="update_survival")
 
         self.apply_survival_limit()
         if save:
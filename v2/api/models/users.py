@@ -2,20 +2,25 @@
 
 from bson import json_util
 from bson.objectid import ObjectId
+from collections import OrderedDict
 from copy import copy
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from flask import Response, request
-from hashlib import md5
+from hashlib import md5, sha256
 import json
 import jwt
 import os
 import random
 import socket
 import string
+import threading
+import time
 from werkzeug.security import safe_str_cmp
 
+import encoders
 import Models
+from models import campaigns
 from settlements import Settlement
 import user_preferences
 import settings
@@ -128,8 +133,7 @@ def initiate_password_reset():
         tmp_file = os.path.join(settings.get("api","cwd"), "html/password_recovery.html")
         msg = string.Template(file(tmp_file, "rb").read())
         msg = msg.safe_substitute(login=user_login, recovery_code=user_code, app_url=utils.get_application_url())
-        e = utils.mailSession()
-        e.send(recipients=[user_login], html_msg=msg)
+        utils.queue_email(recipients=[user_login], html_msg=msg)
     except Exception as e:
         logger.error(e)
         raise
@@ -154,10 +158,63 @@ def jwt_identity_handler(payload):
 
 
 
+#
+#   identity cache: token_to_object() keeps the identities of tokens it has
+#   already checked for 'identity_cache_ttl' seconds (or until the token
+#   expires, if that's sooner), so that it doesn't have to decode them and look
+#   them up on every request. Strict and non-strict checks are cached
+#   separately, i.e. a token that only passed the non-strict check never gets
+#   past a strict one.
+#
+
+identity_cache = OrderedDict()
+identity_cache_max = 5000
+identity_cache_lock = threading.Lock()
+
+
+def get_cached_identity(auth_token, strict=True):
+    """ Returns the cached {'_id': OID, 'login': str} dict for 'auth_token' or
+    None, if we don't have one (or if it's expired). """
+
+    key = (sha256(auth_token).hexdigest(), strict)
+    with identity_cache_lock:
+        cached = identity_cache.get(key, None)
+        if cached is None:
+            return None
+        expires_on, identity = cached
+        if time.time() >= expires_on:
+            del identity_cache[key]
+            return None
+        return identity
+
+
+def set_cached_identity(auth_token, identity, strict=True, token_exp=None):
+    """ Caches 'identity' (i.e. a dict with '_id' and 'login' keys) for
+    'auth_token' until 'identity_cache_ttl' seconds from now or 'token_exp'
+    (the token's 'exp' claim), whichever comes first. Pops the oldest entry, if
+    the cache is full. """
+
+    key = (sha256(auth_token).hexdigest(), strict)
+    expires_on = time.time() + settings.get("api", "identity_cache_ttl")
+    if token_exp is not None:
+        expires_on = min(expires_on, token_exp)
+    if expires_on <= time.time():
+        return None
+
+    with identity_cache_lock:
+        identity_cache[key] = (expires_on, {'_id': identity['_id'], 'login': identity['login']})
+        while len(identity_cache) > identity_cache_max:
+            identity_cache.popitem(last=False)
+
+
 def token_to_object(request, strict=True):
     """ Processes the "Authorization" param in the header and returns an http
     response OR a user object. Requires the application's initialized JWT to
-    work. """
+    work.
+
+    The user object is a UserPrincipal, i.e. we don't actually load the user
+    (and we don't hit the MDB at all, if the token's identity is cached) until
+    somebody needs more than its _id and login. """
     # khoa's back door - chop this whole block when he gets CORS sorted out
     if request.method == "POST" and request.json is not None and request.json.get('user_id', None) is not None:
         logger.warn("'user_id' key in POST body; attempting Khoa-style token-less auth...")
@@ -184,15 +241,22 @@ def token_to_object(request, strict=True):
         logger.error(msg)
         raise utils.InvalidUsage(msg, status_code=401)
 
+    # if we've seen this token recently, we're done
+    identity = get_cached_identity(auth_token, strict)
+    if identity is not None:
+        return UserPrincipal(identity)
+
     # now, try to decode the token and get a dict
     try:
         if strict:
             decoded = jwt.decode(auth_token, secret_key, verify=True)
             user_dict = dict(json.loads(decoded["identity"]))
-            return User(_id=user_dict["_id"]["$oid"])
+            user_dict = utils.mdb.users.find_one({"_id": ObjectId(user_dict["_id"]["$oid"])}, {"login": True})
         else:
+            decoded = jwt.decode(auth_token, secret_key, verify=False)
             user_dict = refresh_authorization(auth_token)
-            return User(_id=user_dict["_id"])
+        set_cached_identity(auth_token, user_dict, strict, decoded.get('exp', None))
+        return UserPrincipal(user_dict)
     except jwt.DecodeError:
         logger.error("Incorrectly formatted token!")
         logger.error("Token contents: |%s|" % auth_token)
@@ -203,6 +267,58 @@ def token_to_object(request, strict=True):
 
 
 
+#
+#   UserPrincipal is what token_to_object() returns
+#
+
+class UserPrincipal(object):
+    """ A lightweight stand-in for a User object: it knows the user's _id and
+    login, and that's it. Anything else (including 'user', i.e. the MDB doc)
+    loads the full User object and gets it from there, so code that uses
+    request.User doesn't have to care which one it's got. """
+
+    def __init__(self, identity):
+        self._id = identity['_id']
+        self.id = str(self._id)
+        self.login = identity['login']
+        self.full_user = None
+
+
+    def __repr__(self):
+        return "[%s (%s)]" % (self.login, self._id)
+
+
+    def __getattr__(self, name):
+        """ Only called for attributes we don't have, i.e. it's time to load
+        the full User object. """
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.get_user(), name)
+
+
+    def get_user(self):
+        """ Returns the full User object, loading it if necessary. """
+        if self.full_user is None:
+            self.full_user = User(_id=self._id)
+        return self.full_user
+
+
+    def set_latest_action(self, activity_string=None, ua_string=None):
+        """ Same as User.set_latest_action(), except that we don't load the
+        user to do it: we just $set the attributes. """
+
+        latest = {
+            'latest_action': activity_string,
+            'latest_activity': datetime.now(),
+            'latest_user_agent': ua_string,
+        }
+        if self.full_user is not None:
+            self.full_user.set_latest_action(activity_string, ua_string)
+        else:
+            utils.mdb.users.update_one({'_id': self._id}, {'$set': latest})
+
+
+
 #
 #   The big User object starts here
 #
@@ -638,10 +754,15 @@ class User(Models.UserAsset):
         if len(campaigns) > 0:
             for s in campaigns:
                 friend_ids.add(s["created_by"])
-                c_survivors = utils.mdb.survivors.find({"settlement": s["_id"]})
-                for survivor in c_survivors:
-                    friend_ids.add(survivor["created_by"])
-                    friend_emails.add(survivor["email"])
+
+            # one query for all of the campaigns' survivors
+            c_survivors = utils.mdb.survivors.find(
+                {"settlement": {"$in": [s["_id"] for s in campaigns]}},
+                {"created_by": True, "email": True},
+            )
+            for survivor in c_survivors:
+                friend_ids.add(survivor["created_by"])
+                friend_emails.add(survivor["email"])
 
             # you can't be friends with yourself
             if self.user["_id"] in friend_ids:
@@ -686,7 +807,7 @@ class User(Models.UserAsset):
         return la
 
 
-    def get_settlements(self, qualifier=None, return_type=None):
+    def get_settlements(self, qualifier=None, return_type=None, projection=None):
         """ By default, this returns all settlements created by the user. Use
         the qualifiers thus:
 
@@ -695,30 +816,35 @@ class User(Models.UserAsset):
             'admin' - returns only the settlements where the user is an admin
                 but is NOT the creator of the settlement.
 
+        Use the 'projection' kwarg (a list of keys) to only get those keys (and
+        the ones that the freemium check needs) back.
         """
 
+        if projection is not None:
+            projection = dict([(k, True) for k in projection + ['name', 'created_on', 'created_by']])
+
         if qualifier is None:
             settlements = utils.mdb.settlements.find({"$or": [
                 {"created_by": self.user["_id"], "removed": {"$exists": False}, },
                 {"admins": {"$in": [self.user["login"], ]}, "removed": {"$exists": False}, },
-            ]})
+            ]}, projection)
         elif qualifier == "player":
             settlement_id_set = set()
 
-            survivors = self.get_survivors(qualifier="player")
+            survivors = self.get_survivors(qualifier="player", projection=['settlement'])
             for s in survivors:
                 settlement_id_set.add(s["settlement"])
 
-            settlements_owned = self.get_settlements()
+            settlements_owned = self.get_settlements(projection=[])
             for s in settlements_owned:
                 settlement_id_set.add(s["_id"])
-            settlements = utils.mdb.settlements.find({"_id": {"$in": list(settlement_id_set)}, "removed": {"$exists": False}})
+            settlements = utils.mdb.settlements.find({"_id": {"$in": list(settlement_id_set)}, "removed": {"$exists": False}}, projection)
         elif qualifier == "admin":
             settlements = utils.mdb.settlements.find({
                 "admins": {"$in": [self.user["login"]]},
                 "created_by": {"$ne": self.user["_id"]},
                 "removed": {"$exists": False},
-            })
+            }, projection)
         else:
             raise Exception("'%s' is not a valid qualifier for this method!" % qualifier)
 
@@ -753,10 +879,9 @@ class User(Models.UserAsset):
                         user_email = request.User.login,
                         user_id = request.User._id,
                     )
-                    e = utils.mailSession()
-                    e.send(subject="Settlement auto-remove! [%s]" % socket.getfqdn(), recipients=settings.get('application','email_alerts').split(','), html_msg=msg)
+                    utils.queue_email(subject="Settlement auto-remove! [%s]" % socket.getfqdn(), recipients=settings.get('application','email_alerts').split(','), html_msg=msg)
                     s['removed'] = datetime.now()
-                    utils.mdb.settlements.save(s)
+                    utils.mdb.settlements.update_one({'_id': s['_id']}, {'$set': {'removed': s['removed']}, '$inc': {'revision': 1}})
                     settlements.remove(s)
 
         #
@@ -770,6 +895,8 @@ class User(Models.UserAsset):
             return output
         elif return_type == 'list_of_dicts':
             return settlements
+        elif return_type == 'summary':
+            return self.get_settlement_summaries(settlements)
         elif return_type == "asset_list":
             output = []
             for s in settlements:
@@ -787,32 +914,110 @@ class User(Models.UserAsset):
         return settlements
 
 
+    def get_settlement_summaries(self, settlements):
+        """ Turns a list of (projected) settlement dicts, e.g. from
+        self.get_settlements(), into a list of dashboard 'cards'.
+
+        This is the cheap alternative to initializing and serializing each
+        settlement (i.e. the 'asset_list' return type of get_settlements()):
+        it does one aggregate() for all of the survivor counts and one find()
+        for the creators' logins, no matter how many settlements there are.
+
+        Settlements with a campaign that isn't in the campaigns assets (e.g.
+        legacy values) get logged and fall back to the raw campaign value,
+        rather than blowing up the whole dashboard. """
+
+        s_ids = [s['_id'] for s in settlements]
+
+        # survivor counts and player emails, for all settlements at once
+        survivor_stats = {}
+        results = utils.mdb.survivors.aggregate([
+            {'$match': {'settlement': {'$in': s_ids}, 'removed': {'$exists': False}}},
+            {'$group': {
+                '_id': '$settlement',
+                'total': {'$sum': 1},
+                'dead': {'$sum': {'$cond': [{'$ifNull': ['$dead', False]}, 1, 0]}},
+                'players': {'$addToSet': '$email'},
+            }},
+        ])
+        for r in results:
+            survivor_stats[r['_id']] = r
+
+        creator_ids = list(set([s['created_by'] for s in settlements]))
+        creators = dict([(u['_id'], u['login']) for u in utils.mdb.users.find({'_id': {'$in': creator_ids}}, {'login': True})])
+
+        C = campaigns.Assets()
+        output = []
+        for s in settlements:
+            stats = survivor_stats.get(s['_id'], {'total': 0, 'dead': 0, 'players': []})
+            campaign = s.get('campaign', 'people_of_the_lantern')
+            try:
+                c_dict = C.get_asset(campaign, backoff_to_name=True)
+            except Exception as e:
+                self.logger.error("%s Settlement %s has an unknown campaign '%s'!" % (self, s['_id'], campaign))
+                self.logger.exception(e)
+                c_dict = {'handle': campaign, 'name': campaign}
+            output.append({
+                '_id': s['_id'],
+                'name': s['name'],
+                'campaign': c_dict['handle'],
+                'campaign_pretty': c_dict['name'],
+                'expansions': s.get('expansions', []),
+                'lantern_year': s.get('lantern_year', 0),
+                'population': s.get('population', 0),
+                'death_count': s.get('death_count', 0),
+                'created_on': s['created_on'],
+                'age': utils.get_time_elapsed_since(s['created_on'], 'age'),
+                'last_accessed': s.get('last_accessed', None),
+                'creator_email': creators.get(s['created_by'], None),
+                'is_creator': s['created_by'] == self.user['_id'],
+                'is_admin': self.user['login'] in s.get('admins', []),
+                'survivors': {
+                    'total': stats['total'],
+                    'living': stats['total'] - stats['dead'],
+                    'dead': stats['dead'],
+                },
+                'player_email_list': sorted([e for e in stats['players'] if e is not None]),
+            })
+
+        return output
+
+
     def get_subscriber_level(self):
         """ Returns the user's subscriber level as an int. """
         p = self.get_patron_attributes()
         return p['level']
 
 
-    def get_survivors(self, qualifier=None, return_type=None):
-        """ Returns all of the survivors created by the user. """
+    def get_survivors(self, qualifier=None, return_type=None, projection=None):
+        """ Returns all of the survivors created by the user.
+
+        Use the 'projection' kwarg (a list of keys) to only get those keys (and
+        the '_id') back, i.e. if you don't need the whole survivor document.
+        int and list 'return_type' calls only ever get the '_id'. """
+
+        if return_type in [int, list]:
+            projection = ['_id']
+        if projection is not None:
+            projection = dict([(k, True) for k in projection])
 
         if qualifier is None:
             survivors = utils.mdb.survivors.find({"$or": [
                 {"created_by": self.user["_id"], "removed": {"$exists": False}},
                 {"email": self.user["login"], "removed": {"$exists": False}},
-            ]})
+            ]}, projection)
 
         elif qualifier == "player":
             survivors = utils.mdb.survivors.find({"$or": [
                 {"created_by": self.user["_id"], "removed": {"$exists": False}},
                 {"email": self.user["login"], "removed": {"$exists": False}},
-            ]})
+            ]}, projection)
         elif qualifier == "owner":
             survivors = utils.mdb.survivors.find({
                 "email": self.user["login"],
                 "created_by": {"$ne": self.user["_id"]},
                 "removed": {"$exists": False},
-            })
+            }, projection)
         else:
             raise Exception("'%s' is not a valid qualifier for this method!" % qualifier)
 
@@ -889,6 +1094,13 @@ class User(Models.UserAsset):
             return Response(response=self.serialize(), status=200, mimetype="application/json")
         elif action == "dashboard":
             return Response(response=self.serialize('dashboard'), status=200, mimetype="application/json")
+        elif action == "get_dashboard_summary":
+            summary_keys = ['campaign', 'expansions', 'lantern_year', 'population', 'death_count', 'last_accessed', 'admins']
+            output = {
+                'campaigns': self.get_settlements(qualifier='player', return_type='summary', projection=summary_keys),
+                'settlements': self.get_settlements(return_type='summary', projection=summary_keys),
+            }
+            return Response(response=encoders.dumps(output), status=200, mimetype="application/json")
         elif action == "set":
             return self.set_attrib()
 
@@ -44,6 +44,38 @@ def get_settlement_data():
 
 
 
+def get_mongo_stats():
+    """ Returns JSON about the MDB commands that API requests make, by route
+    and method, from the buckets that utils.ResponseTimeMetrics writes. Routes
+    are sorted by average commands per request, i.e. N+1 offenders first. """
+
+    results = utils.mdb.api_response_time_buckets.aggregate([
+        {"$match": {"mongo": {"$exists": True}}},
+        {"$group": {
+            "_id": {"url": "$url", "method": "$method"},
+            "requests": {"$sum": "$count"},
+            "queries": {"$sum": "$mongo.count"},
+            "docs": {"$sum": "$mongo.docs"},
+            "time": {"$sum": "$mongo.time"},
+            "max_queries": {"$max": "$mongo.max_count"},
+        }},
+    ])
+
+    totals = {"requests": 0, "queries": 0, "docs": 0, "time": 0.0}
+    routes = []
+    for r in results:
+        for k in totals.keys():
+            totals[k] += r[k]
+        r['avg_queries'] = r['queries'] / float(r['requests'])
+        r['avg_docs'] = r['docs'] / float(r['requests'])
+        r['avg_time'] = r['time'] / r['requests']
+        routes.append(r)
+
+    routes = sorted(routes, key=lambda r: r['avg_queries'], reverse=True)
+    return json.dumps({'totals': totals, 'routes': routes}, default=json_util.default)
+
+
+
 def get_user_data():
     """ Returns JSON about active and recently active users, as well as info
     about user agents, etc. """
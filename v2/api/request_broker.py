@@ -1,7 +1,9 @@
 #!/usr/bin/python2.7
 
-from flask import request, Response
+from flask import request, Response, make_response
 from bson import json_util
+from bson.objectid import ObjectId, InvalidId
+import hashlib
 import json
 
 import notifications
@@ -9,7 +11,8 @@ import panel
 import utils
 
 from models import abilities_and_impairments, survivors, settlements, users, monsters, campaigns, disorders, expansions, fighting_arts, gear, resources, storage
-from Models import AssetLoadError
+from Models import AssetLoadError, AssetConcurrencyError
+import settings
 
 logger = utils.get_logger(log_name="server")
 
@@ -45,7 +48,7 @@ class badResponse():
         if isinstance(e, AssetLoadError):
             self.logger.warn("Requested asset _id could not be initialized!")
             return utils.http_404
-        elif isinstance(e, utils.InvalidUsage):
+        elif isinstance(e, (utils.InvalidUsage, AssetConcurrencyError)):
             raise e
 
         self.logger.exception(e)
@@ -75,6 +78,8 @@ def get_admin_data(resource=None):
             return panel.get_settlement_data()
         elif resource == 'logs':
             return panel.serialize_system_logs()
+        elif resource == 'mongo_stats':
+            return panel.get_mongo_stats()
         elif resource == 'webapp_alerts':
             return notifications.get_webapp_alerts()
     except Exception as e:
@@ -91,19 +96,153 @@ def get_user_asset(collection=None, asset_id=None):
 
     R = badResponse()
     try:
-        if collection == "settlement":
-            return settlements.Settlement(_id=asset_id)
-        elif collection == "survivor":
-            return survivors.Survivor(_id=asset_id)
-        elif collection == "user":
-            return users.User(_id=asset_id)
-        else:
-            return R
+        with utils.request_span('load'):
+            if collection == "settlement":
+                return settlements.Settlement(_id=asset_id)
+            elif collection == "survivor":
+                return survivors.Survivor(_id=asset_id)
+            elif collection == "user":
+                return users.User(_id=asset_id)
+            else:
+                return R
 
     except Exception as e:
         return R.send_bad_response(e)
 
 
+def get_user_asset_etag(collection=None, asset_id=None, action=None, asset_object=None):
+    """ Works out an ETag for a 'get' type action on a settlement or survivor.
+
+    Settlement and survivor docs get a new 'revision' every time they're saved
+    (see Models.UserAsset.save()), and settlements get a new 'related_revision'
+    every time one of their survivors, notes or event log lines is written
+    (see utils.touch_settlements()). Survivor responses (e.g. lineage) depend
+    on the settlement and its other survivors, so the ETag is a hash of the
+    settlement's revisions (plus the survivor's, for survivors), the API
+    version, the user, the action and the request params.
+
+    If 'asset_object' is a loaded asset, we get the revisions from it, i.e.
+    without doing any queries. Otherwise, we do one projected find_one() for
+    a settlement (two for a survivor), WITHOUT initializing anything.
+
+    Returns None if we can't do an ETag for the request (or the asset doesn't
+    exist, in which case the normal request processing can do the 404). """
+
+    if collection not in ['settlement', 'survivor'] or not action.startswith('get'):
+        return None
+
+    settlement_projection = {'revision': 1, 'related_revision': 1}
+
+    if asset_object is not None:
+        if collection == 'survivor':
+            revisions = [asset_object.survivor.get('revision', None)]
+            settlement = getattr(asset_object.Settlement, 'settlement', None)
+        else:
+            revisions = []
+            settlement = asset_object.settlement
+    else:
+        try:
+            oid = ObjectId(asset_id)
+        except (InvalidId, TypeError):
+            return None
+
+        if collection == 'survivor':
+            survivor = utils.mdb.survivors.find_one({'_id': oid}, {'revision': 1, 'settlement': 1})
+            if survivor is None:
+                return None
+            revisions = [survivor.get('revision', None)]
+            settlement = utils.mdb.settlements.find_one({'_id': survivor.get('settlement', None)}, settlement_projection)
+        else:
+            revisions = []
+            settlement = utils.mdb.settlements.find_one({'_id': oid}, settlement_projection)
+
+    if settlement is None:
+        return None
+    revisions.extend([settlement.get('revision', None), settlement.get('related_revision', None)])
+
+    etag = [
+        settings.get('api', 'version'),
+        collection,
+        action,
+        str(asset_id),
+        getattr(request.User, '_id', None),
+        request.query_string,
+        request.get_data(),
+        revisions,
+    ]
+    return hashlib.sha1(repr(etag)).hexdigest()
+
+
+def user_asset_request_response(collection=None, asset_id=None, action=None):
+    """ Initializes a user asset and calls its request_response() method.
+
+    For 'get' type actions on settlements and survivors, if the request has an
+    If-None-Match header, we do a cheap check first: if it has the asset's
+    current ETag (see get_user_asset_etag()), we return a 304 without loading
+    anything. Otherwise, the response gets the ETag (from the loaded asset,
+    i.e. for free).
+
+    If the asset's save() raises an AssetConcurrencyError (i.e. somebody else
+    saved it while we were working on it), we throw our copy away, load it
+    again and re-do the whole action, up to settings.api.save_retries times.
+
+    Re-doing an action is only safe if the failed attempt didn't write anything
+    else (e.g. survivors, other saves of the asset, emails; see
+    utils.record_asset_write()), so if it did, or if we run out of retries, we
+    give up and return a 409. Events logged by a failed attempt are thrown away
+    with it: each attempt gets its own EventSink, and only the one that works
+    gets merged into the request's. """
+
+    if request.if_none_match:
+        with utils.request_span('etag'):
+            etag = get_user_asset_etag(collection, asset_id, action)
+
+        if etag is not None and request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+
+    retries = settings.get('api', 'save_retries')
+    request_sink = getattr(request, 'event_sink', None)
+
+    for attempt in range(retries + 1):
+        request.event_sink = utils.EventSink()
+        request.asset_writes = []
+        try:
+            asset_object = get_user_asset(collection, asset_id)
+            if type(asset_object) == Response:
+                response = asset_object
+            else:
+                response = asset_object.request_response(action)
+                etag = get_user_asset_etag(collection, asset_id, action, asset_object)
+                if etag is not None:
+                    response = make_response(response)
+                    if response.status_code == 200:
+                        response.set_etag(etag)
+                        response.headers['Cache-Control'] = 'private, no-cache'
+        except AssetConcurrencyError:
+            logger.warn("'%s' action on %s hit a save conflict! (attempt %s of %s)" % (action, asset_id, attempt + 1, retries + 1))
+            if request.asset_writes != []:
+                logger.warn("'%s' action on %s already wrote %s; not retrying it!" % (action, asset_id, request.asset_writes))
+                break
+            continue
+        finally:
+            attempt_sink = request.event_sink
+            if request_sink is None:
+                del request.event_sink
+            else:
+                request.event_sink = request_sink
+
+        if request_sink is None:
+            attempt_sink.flush()
+        else:
+            request_sink.merge(attempt_sink)
+        return response
+
+    return Response(response="The %s was modified by another request! Please try again." % collection, status=409)
+
+
 def get_game_asset(collection):
     """ Simliar to get_user_asset(), except for game assets, such as monsters,
     gear, locations, etc.
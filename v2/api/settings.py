@@ -8,6 +8,18 @@ import logging
 from optparse import OptionParser
 import os
 import sys
+import threading
+import time
+
+
+# how often (in seconds) get_settings() is allowed to stat() the settings file
+# to see if it has changed
+mtime_check_interval = 1
+
+# parsed Settings objects, by settings_type; see get_settings()
+cache = {}
+cache_lock = threading.Lock()
+
 
 class Settings:
 
@@ -31,20 +43,29 @@ class Settings:
 
         self.config = SafeConfigParser()
         self.config.file_path = settings_abs_path
+        self.config.mtime = os.path.getmtime(self.config.file_path)
         self.config.readfp(open(self.config.file_path))
         self.config.settings_type = settings_type
 
+        self.values = {}    # duck-typed values from get()
         self.load_api_keys()
 
 
     def load_api_keys(self):
         """ Looks for an API keys file and tries to read it. If it doesn't
-        find one, it sets self.secret_keys to be an empty dict. """
+        find one, it sets self.secret_keys to be an empty dict.
+
+        Keeps the file's mtime (None, if there's no file), so that is_stale()
+        can tell when the keys have changed. """
 
         self.api_keys = {}
+        self.api_keys_file = None
+        self.api_keys_mtime = None
 
         try:
-            fh = file(self.get("api","api_keys_file"), "rb")
+            self.api_keys_file = self.get("api","api_keys_file")
+            self.api_keys_mtime = os.path.getmtime(self.api_keys_file)
+            fh = file(self.api_keys_file, "rb")
         except:
             return False
 
@@ -57,21 +78,66 @@ class Settings:
 
 
     def get(self, section, key):
-        """ Gets a value. Tries to do some duck-typing. """
+        """ Gets a value. Tries to do some duck-typing. Values are memoized,
+        so this only does the parsing/typing the first time. """
+
+        if (section, key) in self.values:
+            return self.values[(section, key)]
 
         raw_value = self.config.get(section,key)
         if raw_value in ["True","False"]:
-            return self.config.getboolean(section,key)
+            value = self.config.getboolean(section,key)
         elif key in ["log_level"]:
             exec "log_level_obj = logging.%s" % raw_value
-            return log_level_obj
+            value = log_level_obj
         else:
             try:
-                return self.config.getint(section,key)
+                value = self.config.getint(section,key)
             except:
-                pass
+                value = raw_value
+
+        self.values[(section, key)] = value
+        return value
+
+
+    def get_as(self, section, key, value_type=str):
+        """ Gets a value as 'value_type' (i.e. str, int, float or bool),
+        without get()'s duck-typing. Memoized, like get(). """
+
+        if (section, key, value_type) in self.values:
+            return self.values[(section, key, value_type)]
+
+        getters = {
+            str: self.config.get,
+            int: self.config.getint,
+            float: self.config.getfloat,
+            bool: self.config.getboolean,
+        }
+        value = getters[value_type](section, key)
+
+        self.values[(section, key, value_type)] = value
+        return value
+
+
+    def is_stale(self):
+        """ Returns True if the file this object was loaded from (or its API
+        keys file) has been modified, created or deleted since it was loaded. """
+
+        try:
+            if os.path.getmtime(self.config.file_path) != self.config.mtime:
+                return True
+        except OSError:
+            return True
+
+        if self.api_keys_file is not None:
+            try:
+                keys_mtime = os.path.getmtime(self.api_keys_file)
+            except OSError:
+                keys_mtime = None
+            if keys_mtime != self.api_keys_mtime:
+                return True
 
-        return raw_value
+        return False
 
 
     def jsonify(self):
@@ -95,11 +161,33 @@ class Settings:
         return s_file
 
 
+def get_settings(settings_type=None):
+    """ Returns a cached Settings object for 'settings_type'. The cached
+    object gets re-initialized (i.e. the file gets re-read) when the file's
+    (or the API keys file's) mtime changes, but we only stat() the file once every
+    'mtime_check_interval' seconds. """
+
+    with cache_lock:
+        now = time.time()
+        cached = cache.get(settings_type, None)
+        if cached is not None:
+            S, checked_on = cached
+            if now - checked_on < mtime_check_interval:
+                return S
+            if not S.is_stale():
+                cache[settings_type] = (S, now)
+                return S
+
+        S = Settings(settings_type)
+        cache[settings_type] = (S, now)
+        return S
+
+
 def check_key(k=None):
     """ Laziness/convenience function to check a key without initializing a
     settings object. """
 
-    S = Settings()
+    S = get_settings()
     if k in S.api_keys.keys():
         return S.api_keys[k]   # i.e. return the user name
     else:
@@ -113,12 +201,33 @@ def get(section=None, query=None, private=False):
     if section is None or query is None:
         raise TypeError("settings.get() does not accept None type arguments.")
     if not private:
-        S = Settings()
+        S = get_settings()
     else:
-        S = Settings("private")
+        S = get_settings("private")
     return S.get(section,query)
 
 
+#
+#   typed accessors: these skip get()'s duck-typing
+#
+
+def get_int(section, key, private=False):
+    """ Returns the value of 'key' as an int. """
+    return get_settings("private" if private else None).get_as(section, key, int)
+
+def get_float(section, key, private=False):
+    """ Returns the value of 'key' as a float. """
+    return get_settings("private" if private else None).get_as(section, key, float)
+
+def get_bool(section, key, private=False):
+    """ Returns the value of 'key' as a bool. """
+    return get_settings("private" if private else None).get_as(section, key, bool)
+
+def get_str(section, key, private=False):
+    """ Returns the value of 'key' as a string, i.e. the raw value. """
+    return get_settings("private" if private else None).get_as(section, key, str)
+
+
 def update(section=None, key=None, value=None):
     """ Sets a key/value in a section, writes a new file and exits. """
     if section is None or key is None or value is None:
@@ -128,6 +237,7 @@ def update(section=None, key=None, value=None):
     S.config.set(section, key, value)
     with open(S.config.file_path, 'wb') as c_file:
         S.config.write(c_file)
+    cache.clear()
 
 
 if __name__=="__main__":
@@ -101,6 +101,7 @@ myApp.controller('globalController', function($scope, $http, $interval) {
             }
         );
         $http.get('admin/get/logs').then(function(result){$scope.logs = result.data;});
+        $http.get('admin/get/mongo_stats').then(function(result){$scope.mongo_stats = result.data;});
 
         $http.get('world').then(function(result){
             $scope.world = result.data;
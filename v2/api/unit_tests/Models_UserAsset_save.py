@@ -0,0 +1,191 @@
+#!/usr/bin/python2.7
+
+#
+#   Tests for Models.UserAsset.save(): the $set/$unset/$push/$pull deltas that
+#   get_save_delta() works out (i.e. that feeding them to update_one() really
+#   gets us from the old doc to the new one) and the 'revision' check that
+#   raises an AssetConcurrencyError. These write to the MDB (and clean up after
+#   themselves), so run them from the v2/api dir on a dev box, e.g.:
+#
+#       $ python unit_tests/Models_UserAsset_save.py
+#
+
+from bson.objectid import ObjectId
+from copy import deepcopy
+from datetime import datetime
+import unittest
+
+import unit_test
+
+logger = unit_test.set_env()
+
+import Models
+import utils
+
+
+class TestAsset(Models.UserAsset):
+    """ A bare UserAsset for a doc that we've already inserted, i.e. without
+    all of the load()/normalize() business of a real settlement or survivor. """
+
+    def __init__(self, collection, _id):
+        self.logger = logger
+        self.collection = collection
+        self._id = _id
+        setattr(self, collection[:-1], utils.mdb[collection].find_one({'_id': _id}))
+        self.set_mdb_doc_snapshot(getattr(self, collection[:-1]))
+
+
+class SaveDeltaTests(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = utils.mdb.unit_test_save_deltas
+        self.asset = TestAsset.__new__(TestAsset)
+        self.old_doc = {
+            '_id': ObjectId(),
+            'name': 'Test Survivor',
+            'Insanity': 3,
+            'retired': True,
+            'created_on': datetime(2017, 1, 1, 12, 0, 0),
+            'fighting_arts': ['timeless_eye', 'berserker'],
+            'epithets': ['lantern_hoard'],
+            'notes': [{'note': 'one'}, {'note': 'two'}],
+            'attribute_detail': {'Strength': {'tokens': 0, 'gear': 0}, 'Luck': {'tokens': 1, 'gear': 0}},
+            'milestone_story_events': {'first_child': True},
+        }
+        self.collection.insert_one(self.old_doc)
+
+    def tearDown(self):
+        self.collection.delete_one({'_id': self.old_doc['_id']})
+
+    def round_trip(self, new_doc):
+        """ Saves the delta from self.old_doc to 'new_doc' and checks that the
+        MDB doc is now 'new_doc'. Returns the delta. """
+        delta = self.asset.get_save_delta(self.old_doc, new_doc)
+        if delta != {}:
+            self.collection.update_one({'_id': self.old_doc['_id']}, delta)
+        self.assertEqual(self.collection.find_one({'_id': self.old_doc['_id']}), new_doc)
+        return delta
+
+    def test_no_change(self):
+        self.assertEqual(self.round_trip(deepcopy(self.old_doc)), {})
+
+    def test_set(self):
+        new_doc = deepcopy(self.old_doc)
+        new_doc['name'] = 'Renamed'
+        new_doc['Insanity'] = 5
+        new_doc['dead'] = True
+        delta = self.round_trip(new_doc)
+        self.assertEqual(delta, {'$set': {'name': 'Renamed', 'Insanity': 5, 'dead': True}})
+
+    def test_unset(self):
+        new_doc = deepcopy(self.old_doc)
+        del new_doc['retired']
+        delta = self.round_trip(new_doc)
+        self.assertEqual(delta, {'$unset': {'retired': ''}})
+
+    def test_push(self):
+        new_doc = deepcopy(self.old_doc)
+        new_doc['fighting_arts'].extend(['crossarm_block', 'tough'])
+        new_doc['notes'].append({'note': 'three'})
+        delta = self.round_trip(new_doc)
+        self.assertEqual(delta, {'$push': {
+            'fighting_arts': {'$each': ['crossarm_block', 'tough']},
+            'notes': {'$each': [{'note': 'three'}]},
+        }})
+
+    def test_pull(self):
+        new_doc = deepcopy(self.old_doc)
+        new_doc['fighting_arts'].remove('timeless_eye')
+        new_doc['epithets'] = []
+        delta = self.round_trip(new_doc)
+        self.assertEqual(delta, {'$pull': {
+            'fighting_arts': {'$in': ['timeless_eye']},
+            'epithets': {'$in': ['lantern_hoard']},
+        }})
+
+    def test_list_reorder_and_dict_items_are_set(self):
+        new_doc = deepcopy(self.old_doc)
+        new_doc['fighting_arts'].reverse()
+        new_doc['notes'] = [{'note': 'two'}]
+        delta = self.round_trip(new_doc)
+        self.assertEqual(delta, {'$set': {'fighting_arts': ['berserker', 'timeless_eye'], 'notes': [{'note': 'two'}]}})
+
+    def test_dotted_dict_keys(self):
+        new_doc = deepcopy(self.old_doc)
+        new_doc['attribute_detail']['Strength']['tokens'] = 2
+        new_doc['attribute_detail']['Evasion'] = {'tokens': 1, 'gear': 0}
+        del new_doc['milestone_story_events']['first_child']
+        delta = self.round_trip(new_doc)
+        self.assertEqual(delta, {
+            '$set': {
+                'attribute_detail.Strength': {'tokens': 2, 'gear': 0},
+                'attribute_detail.Evasion': {'tokens': 1, 'gear': 0},
+            },
+            '$unset': {'milestone_story_events.first_child': ''},
+        })
+
+    def test_everything_at_once(self):
+        new_doc = deepcopy(self.old_doc)
+        new_doc['name'] = 'Renamed'
+        del new_doc['retired']
+        new_doc['fighting_arts'].append('tough')
+        new_doc['epithets'].remove('lantern_hoard')
+        new_doc['attribute_detail']['Luck']['tokens'] = 0
+        delta = self.round_trip(new_doc)
+        self.assertEqual(sorted(delta.keys()), ['$pull', '$push', '$set', '$unset'])
+
+
+class RevisionConflictTests(unittest.TestCase):
+
+    def setUp(self):
+        self._id = ObjectId()
+        utils.mdb.survivors.insert_one({'_id': self._id, 'name': 'Test Survivor', 'Insanity': 0, 'revision': 4})
+
+    def tearDown(self):
+        utils.mdb.survivors.delete_one({'_id': self._id})
+
+    def test_save_bumps_revision(self):
+        S = TestAsset('survivors', self._id)
+        S.survivor['Insanity'] = 1
+        S.save(verbose=False)
+        self.assertEqual(S.survivor['revision'], 5)
+        self.assertEqual(utils.mdb.survivors.find_one({'_id': self._id}), S.survivor)
+
+        # a second save from the same object must not conflict with itself
+        S.survivor['Insanity'] = 2
+        S.save(verbose=False)
+        self.assertEqual(utils.mdb.survivors.find_one({'_id': self._id})['revision'], 6)
+
+    def test_save_without_changes_does_nothing(self):
+        S = TestAsset('survivors', self._id)
+        S.save(verbose=False)
+        self.assertEqual(utils.mdb.survivors.find_one({'_id': self._id})['revision'], 4)
+
+    def test_conflict(self):
+        first = TestAsset('survivors', self._id)
+        second = TestAsset('survivors', self._id)
+
+        first.survivor['Insanity'] = 1
+        first.save(verbose=False)
+
+        second.survivor['name'] = 'Renamed'
+        self.assertRaises(Models.AssetConcurrencyError, second.save, verbose=False)
+
+        # the second save must not have written anything
+        self.assertEqual(utils.mdb.survivors.find_one({'_id': self._id}), first.survivor)
+
+    def test_conflict_without_revision(self):
+        utils.mdb.survivors.update_one({'_id': self._id}, {'$unset': {'revision': ''}})
+        first = TestAsset('survivors', self._id)
+        second = TestAsset('survivors', self._id)
+
+        first.survivor['Insanity'] = 1
+        first.save(verbose=False)
+        self.assertEqual(first.survivor['revision'], 1)
+
+        second.survivor['Insanity'] = 2
+        self.assertRaises(Models.AssetConcurrencyError, second.save, verbose=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/python2.7
+
+#
+#   Benchmark for encoders.dumps() vs. json.dumps(default=json_util.default)
+#   on a settlement-sized payload: 40 survivors, 500 event log lines and a
+#   game assets dict, with ObjectIds and datetimes all over the place, like
+#   the real thing. Also checks that the output is byte-identical. Run it from
+#   the v2/api dir, e.g.:
+#
+#       $ python unit_tests/encoder_bench.py
+#
+
+from bson import json_util
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+import json
+import random
+import timeit
+
+import unit_test
+
+logger = unit_test.set_env()
+
+import encoders
+
+
+def make_survivor(s_id, i):
+    born = datetime.now() - timedelta(days=random.randint(1, 300), microseconds=random.randint(0, 999999))
+    return {
+        "_id": ObjectId(),
+        "settlement": s_id,
+        "name": "Survivor %s" % i,
+        "sex": random.choice(["M", "F"]),
+        "created_on": born,
+        "created_by": ObjectId(),
+        "email": "player%s@kdm-manager.com" % (i % 4),
+        "born_in_ly": random.randint(0, 20),
+        "revision": random.randint(1, 100),
+        "Strength": random.randint(0, 5), "Evasion": 0, "Luck": 1, "Movement": 5, "Accuracy": 0, "Speed": 0,
+        "Insanity": random.randint(0, 12), "survival": random.randint(0, 10), "hunt_xp": random.randint(0, 15),
+        "fighting_arts": ["timeless_eye", "berserker"], "disorders": ["hoarder"],
+        "abilities_and_impairments": ["partner", "bitter_frenzy", "crystal_skin", "sweet_battle"],
+        "epithets": ["lantern_hoard", "twilight_knight"],
+        "notes": [{"_id": ObjectId(), "created_on": born, "note": "note %s" % n} for n in range(3)],
+        "attribute_detail": dict([(a, {"tokens": 0, "gear": 0}) for a in ["Strength", "Evasion", "Luck", "Movement", "Accuracy", "Speed"]]),
+        "meta": {"schema_version": 1, "last_modified": datetime.now()},
+    }
+
+
+def make_payload():
+    s_id = ObjectId()
+    return {
+        "meta": {"object": {"version": 0.81}, "creator_email": "demo@kdm-manager.com", "age": "1 year"},
+        "sheet": {
+            "_id": s_id,
+            "name": "Bench Settlement",
+            "created_on": datetime.now() - timedelta(days=400),
+            "timeline": [{"year": y, "settlement_event": [{"handle": "core_first_day", "name": "First Day"}]} for y in range(40)],
+            "innovations": ["ammonia", "language", "paint", "symposium", "hovel", "lantern_oven"],
+            "locations": ["lantern_hoard", "bone_smith", "skinnery", "organ_grinder"],
+            "storage": ["bone", "hide", "organ"] * 30,
+        },
+        "user_assets": {"survivors": [{"sheet": make_survivor(s_id, i)} for i in range(40)]},
+        "event_log": [{
+            "_id": ObjectId(),
+            "settlement_id": s_id,
+            "created_on": datetime.now() - timedelta(minutes=i),
+            "created_by": ObjectId(),
+            "event": "demo@kdm-manager.com added 'Bone Dagger' to storage.",
+            "ly": i % 20,
+        } for i in range(500)],
+        "game_assets": dict([("asset_%s" % i, {"handle": "asset_%s" % i, "name": "Asset %s" % i, "type": "gear", "keywords": ["item", "bone"]}) for i in range(600)]),
+    }
+
+
+if __name__ == "__main__":
+    payload = make_payload()
+    iterations = 50
+
+    baseline = json.dumps(payload, default=json_util.default)
+    fast = encoders.dumps(payload)
+    print "\n  Payload is %s bytes; byte-identical: %s\n" % (len(baseline), baseline == fast)
+
+    for name, func in [
+        ("json_util.default", lambda: json.dumps(payload, default=json_util.default)),
+        ("encoders.dumps()", lambda: encoders.dumps(payload)),
+    ]:
+        t = timeit.timeit(func, number=iterations)
+        print "  %-20s %8.2f msec/payload" % (name, t / iterations * 1000)
+    print
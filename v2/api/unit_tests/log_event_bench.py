@@ -0,0 +1,67 @@
+#!/usr/bin/python2.7
+
+#
+#   Microbenchmark for the caller detection that UserAsset.log_event() does.
+#
+#   The old way was inspect.getouterframes(), which builds a frame record (with
+#   source context) for the whole stack; the new way is sys._getframe() for
+#   legacy calls, and nothing at all for calls that pass event_type, action and
+#   key. Run it from the v2/api dir, e.g.:
+#
+#       $ python unit_tests/log_event_bench.py
+#
+
+import inspect
+import sys
+import timeit
+
+import unit_test
+
+logger = unit_test.set_env()
+
+import utils
+
+
+def inspect_caller():
+    curframe = inspect.currentframe()
+    calframe = inspect.getouterframes(curframe, 2)
+    return calframe[2][3]
+
+def getframe_caller():
+    return sys._getframe(2).f_code.co_name
+
+def explicit_caller(event_type="set_name", action="set", key="name"):
+    if None in [event_type, action, key]:
+        return sys._getframe(2).f_code.co_name
+    return event_type
+
+
+@utils.log_event_exception_manager
+def log_inspect(self):
+    return inspect_caller()
+
+@utils.log_event_exception_manager
+def log_getframe(self):
+    return getframe_caller()
+
+@utils.log_event_exception_manager
+def log_explicit(self):
+    return explicit_caller()
+
+
+def deep_stack(depth, func):
+    """ Call 'func' with a stack about as deep as a Flask request's. """
+    if depth == 0:
+        return func(None)
+    return deep_stack(depth - 1, func)
+
+
+if __name__ == "__main__":
+    iterations = 2000
+    depth = 40
+
+    print "\n  log_event() caller detection; %s events, %s frames deep:\n" % (iterations, depth)
+    for name, func in [("inspect.getouterframes()", log_inspect), ("sys._getframe()", log_getframe), ("explicit kwargs", log_explicit)]:
+        t = timeit.timeit(lambda: deep_stack(depth, func), number=iterations)
+        print "  %-26s %8.2f usec/event" % (name, t / iterations * 1000000)
+    print
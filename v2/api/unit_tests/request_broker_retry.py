@@ -0,0 +1,145 @@
+#!/usr/bin/python2.7
+
+#
+#   Tests for the save conflict handling in
+#   request_broker.user_asset_request_response(): an action that hits an
+#   AssetConcurrencyError gets re-done on a freshly loaded asset, unless it
+#   already wrote something else, in which case (or if it keeps conflicting)
+#   the response is a 409. Events logged by failed attempts are thrown away.
+#   Run them from the v2/api dir on a dev box, e.g.:
+#
+#       $ python unit_tests/request_broker_retry.py
+#
+
+from bson.objectid import ObjectId
+from flask import Flask
+import unittest
+
+import unit_test
+
+logger = unit_test.set_env()
+
+import Models
+import request_broker
+import settings
+import utils
+
+
+class TestSurvivor(Models.UserAsset):
+    """ A bare survivor asset whose request_response() adds one to its
+    'Insanity', logs an event and saves. Before saving, it calls the class's
+    'before_save' function (if there is one), e.g. to simulate another request
+    saving the survivor first. """
+
+    collection = 'survivors'
+    before_save = None
+
+    def __init__(self, _id):
+        self.logger = logger
+        self._id = _id
+        self.survivor = utils.mdb.survivors.find_one({'_id': _id})
+        self.set_mdb_doc_snapshot(self.survivor)
+
+    def request_response(self, action):
+        self.survivor['Insanity'] += 1
+        utils.request.event_sink.add_event({'event': 'Insanity is %s' % self.survivor['Insanity']})
+        if TestSurvivor.before_save is not None:
+            TestSurvivor.before_save(self)
+        self.save(verbose=False)
+        return utils.http_200
+
+
+class RetryTests(unittest.TestCase):
+
+    def setUp(self):
+        self._id = ObjectId()
+        self.other_id = ObjectId()
+        utils.mdb.survivors.insert_many([
+            {'_id': self._id, 'name': 'Test Survivor', 'Insanity': 0, 'revision': 1},
+            {'_id': self.other_id, 'name': 'Other Survivor', 'Insanity': 0, 'revision': 1},
+        ])
+
+        self.attempts = 0
+        self.get_user_asset = request_broker.get_user_asset
+        request_broker.get_user_asset = self.load
+        self.app = Flask(__name__)
+
+    def tearDown(self):
+        request_broker.get_user_asset = self.get_user_asset
+        TestSurvivor.before_save = None
+        utils.mdb.survivors.delete_many({'_id': {'$in': [self._id, self.other_id]}})
+
+    def load(self, collection, asset_id):
+        self.attempts += 1
+        return TestSurvivor(asset_id)
+
+    def get_response(self):
+        """ Does a request with its own EventSink (like api.py does) and returns
+        the response and the events that made it into the sink. """
+        with self.app.test_request_context('/survivor/set_insanity/%s' % self._id, method='POST'):
+            utils.request.event_sink = utils.EventSink()
+            response = request_broker.user_asset_request_response('survivor', self._id, 'set_insanity')
+            return response, [e['event'] for e in utils.request.event_sink.events]
+
+    def bump_revision(self, S):
+        """ Another request saves the survivor first. """
+        utils.mdb.survivors.update_one({'_id': S._id}, {'$inc': {'revision': 1, 'Insanity': 10}})
+
+    def test_no_conflict(self):
+        response, events = self.get_response()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.attempts, 1)
+        self.assertEqual(events, ['Insanity is 1'])
+
+    def test_conflict_is_retried(self):
+        def conflict_once(S):
+            if self.attempts == 1:
+                self.bump_revision(S)
+        TestSurvivor.before_save = conflict_once
+
+        response, events = self.get_response()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.attempts, 2)
+
+        # the second attempt worked from the other request's save, and the
+        # failed attempt's event was thrown away
+        self.assertEqual(utils.mdb.survivors.find_one({'_id': self._id})['Insanity'], 11)
+        self.assertEqual(events, ['Insanity is 11'])
+
+    def test_conflict_after_another_write_is_not_retried(self):
+        def write_then_conflict(S):
+            utils.mdb.survivors.update_one({'_id': self.other_id}, {'$inc': {'Insanity': 1}})
+            utils.record_asset_write('survivors', self.other_id)
+            self.bump_revision(S)
+        TestSurvivor.before_save = write_then_conflict
+
+        response, events = self.get_response()
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.attempts, 1)
+        self.assertEqual(utils.mdb.survivors.find_one({'_id': self.other_id})['Insanity'], 1)
+        self.assertEqual(events, [])
+
+    def test_too_many_conflicts(self):
+        TestSurvivor.before_save = self.bump_revision
+
+        response, events = self.get_response()
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.attempts, settings.get('api', 'save_retries') + 1)
+        self.assertEqual(events, [])
+
+    def test_conflict_while_loading_is_retried(self):
+        def load(collection, asset_id):
+            self.attempts += 1
+            if self.attempts == 1:
+                raise Models.AssetConcurrencyError()
+            return TestSurvivor(asset_id)
+        request_broker.get_user_asset = load
+
+        response, events = self.get_response()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.attempts, 2)
+        self.assertEqual(events, ['Insanity is 1'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+#!/usr/bin/python2.7
+
+#
+#   Microbenchmark for settings.get(). Compares re-initializing a Settings
+#   object (i.e. re-reading settings.cfg) on every call, which is what get()
+#   used to do, with the cached object that get() uses now. Run it from the
+#   v2/api dir, e.g.:
+#
+#       $ python unit_tests/settings_bench.py
+#
+
+import timeit
+
+import unit_test
+
+logger = unit_test.set_env()
+
+import settings
+
+
+if __name__ == "__main__":
+    iterations = 5000
+
+    print "\n  settings.get('api','mdb'); %s calls:\n" % iterations
+    for name, func in [
+        ("Settings().get()", lambda: settings.Settings().get("api", "mdb")),
+        ("settings.get()", lambda: settings.get("api", "mdb")),
+        ("settings.get_str()", lambda: settings.get_str("api", "mdb")),
+    ]:
+        t = timeit.timeit(func, number=iterations)
+        print "  %-22s %8.2f usec/call" % (name, t / iterations * 1000000)
+    print
@@ -0,0 +1,113 @@
+#!/usr/bin/python2.7
+
+#
+#   Tests for the event log cursors in utils.py, i.e. get_cursor(),
+#   parse_cursor() and get_cursor_query(): paging through a settlement's
+#   settlement_events in either direction has to hit every event exactly once,
+#   in ('created_on', '_id') order, including events with the same
+#   'created_on'. These write to the MDB (and clean up after themselves), so
+#   run them from the v2/api dir on a dev box, e.g.:
+#
+#       $ python unit_tests/utils_event_cursors.py
+#
+
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+import unittest
+
+import unit_test
+
+logger = unit_test.set_env()
+
+import utils
+
+
+class CursorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.settlement_id = ObjectId()
+        self.start = datetime(2017, 6, 1, 12, 0, 0, 123000)
+
+        # three events per millisecond for 5 milliseconds, inserted out of
+        # order, so that created_on ties have to be broken by _id
+        self.events = []
+        for i in range(15):
+            self.events.append({
+                '_id': ObjectId(),
+                'settlement_id': self.settlement_id,
+                'created_on': self.start + timedelta(milliseconds=i / 3),
+                'event': 'event %s' % i,
+            })
+        utils.mdb.settlement_events.insert_many(list(reversed(self.events)))
+
+        # somebody else's event, at the same time
+        self.other_settlement_id = ObjectId()
+        utils.mdb.settlement_events.insert_one({'settlement_id': self.other_settlement_id, 'created_on': self.start, 'event': 'other'})
+
+    def tearDown(self):
+        utils.mdb.settlement_events.delete_many({'settlement_id': {'$in': [self.settlement_id, self.other_settlement_id]}})
+
+    def get_pages(self, direction, page_size, horizon=None):
+        """ Pages through the test settlement's events like get_event_log()
+        does and returns the 'event' strings, page by page. """
+
+        sort = 1 if direction == 'after' else -1
+        pages = []
+        cursor = None
+        for i in range(len(self.events) + 1):
+            query = utils.get_cursor_query('settlement_id', self.settlement_id, cursor, direction, horizon)
+            page = list(utils.mdb.settlement_events.find(query).sort([('created_on', sort), ('_id', sort)]).limit(page_size))
+            if page == []:
+                return pages
+            pages.append([e['event'] for e in page])
+            cursor = utils.get_cursor(page[-1])
+        self.fail("Paging never ended! Pages so far: %s" % pages[:5])
+
+    def test_round_trip(self):
+        e = self.events[4]
+        self.assertEqual(utils.parse_cursor(utils.get_cursor(e)), (e['created_on'], e['_id']))
+
+    def test_round_trip_truncates_to_milliseconds(self):
+        created_on = datetime(2017, 6, 1, 12, 0, 0, 123456)
+        oid = ObjectId()
+        self.assertEqual(utils.parse_cursor(utils.get_cursor({'created_on': created_on, '_id': oid})), (datetime(2017, 6, 1, 12, 0, 0, 123000), oid))
+
+    def test_bad_cursors(self):
+        for cursor in ['', 'garbage', 'MTIzNDU2', utils.get_cursor(self.events[0])[:-3], None]:
+            try:
+                utils.parse_cursor(cursor)
+            except utils.InvalidUsage as e:
+                self.assertEqual(e.status_code, 400)
+            else:
+                self.fail("parse_cursor() accepted '%s'!" % cursor)
+
+    def test_pages_after(self):
+        expected = [e['event'] for e in self.events]
+        for page_size in [1, 2, 3, 4, 15, 20]:
+            pages = self.get_pages('after', page_size)
+            self.assertEqual(sum(pages, []), expected, "page_size %s: %s" % (page_size, pages))
+
+    def test_pages_before(self):
+        expected = [e['event'] for e in reversed(self.events)]
+        for page_size in [1, 2, 3, 4, 15, 20]:
+            pages = self.get_pages('before', page_size)
+            self.assertEqual(sum(pages, []), expected, "page_size %s: %s" % (page_size, pages))
+
+    def test_after_cursor_in_a_tie(self):
+        # the cursor is the middle one of three events with the same created_on
+        query = utils.get_cursor_query('settlement_id', self.settlement_id, utils.get_cursor(self.events[7]), 'after')
+        events = list(utils.mdb.settlement_events.find(query).sort([('created_on', 1), ('_id', 1)]))
+        self.assertEqual([e['event'] for e in events], ['event %s' % i for i in range(8, 15)])
+
+        query = utils.get_cursor_query('settlement_id', self.settlement_id, utils.get_cursor(self.events[7]), 'before')
+        events = list(utils.mdb.settlement_events.find(query).sort([('created_on', -1), ('_id', -1)]))
+        self.assertEqual([e['event'] for e in events], ['event %s' % i for i in range(6, -1, -1)])
+
+    def test_horizon(self):
+        horizon = self.events[8]['created_on']
+        pages = self.get_pages('after', 4, horizon)
+        self.assertEqual(sum(pages, []), ['event %s' % i for i in range(9)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,14 @@
 #!/usr/bin/python2.7
 
 # general imports
+import atexit
+import base64
+import bisect
 from bson import json_util
 from bson.objectid import ObjectId
+import calendar
+from collections import OrderedDict
+import cProfile
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 import email
@@ -11,17 +17,24 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from flask import Response, make_response, request, current_app
 from functools import update_wrapper
+import gzip
+import hashlib
 from HTMLParser import HTMLParser
 import json
 import logging
 import os
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne, monitoring
+import Queue
+import random
 import smtplib
 import socket
+import StringIO
 from string import Template
 import sys
+import threading
 import time
 import traceback
+import zlib
 
 # project-specific imports
 import settings
@@ -29,7 +42,52 @@ import settings
 
 # random, one-off helpers in the main namespace
 
-mdb = MongoClient()[settings.get("api","mdb")]
+class MongoCommandListener(monitoring.CommandListener):
+    """ Instruments MDB commands made during requests:
+
+        - the time spent in them is the 'mongo' phase of the request (see
+            request_span)
+        - the request's 'mongo_stats' dict gets a count of commands, the
+            documents they returned and the time they took, as well as counts
+            by command and collection (e.g. 'find.survivors'), which is how
+            you spot N+1 queries
+
+    pymongo calls these methods in the thread that ran the command, so
+    'request' is the right request. Outside of requests, this does nothing. """
+
+    def started(self, event):
+        if not request or not hasattr(request, 'start_time'):
+            return
+        if not hasattr(request, 'mongo_stats'):
+            request.mongo_stats = {"count": 0, "docs": 0, "time": 0.0, "commands": {}, "pending": {}}
+        collection = event.command.get(event.command_name, None)
+        if event.command_name == 'getMore':
+            collection = event.command.get('collection', None)
+        request.mongo_stats['pending'][event.request_id] = "%s.%s" % (event.command_name, collection)
+
+    def succeeded(self, event):
+        docs = 0
+        cursor = event.reply.get('cursor', None)
+        if isinstance(cursor, dict):
+            docs = len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+        self.record(event, docs)
+
+    def failed(self, event):
+        self.record(event, 0)
+
+    def record(self, event, docs):
+        seconds = event.duration_micros / 1000000.0
+        request_span.add_child_time('mongo', seconds)
+        if not request or not hasattr(request, 'mongo_stats'):
+            return
+        stats = request.mongo_stats
+        label = stats['pending'].pop(event.request_id, event.command_name)
+        stats['count'] += 1
+        stats['docs'] += docs
+        stats['time'] += seconds
+        stats['commands'][label] = stats['commands'].get(label, 0) + 1
+
+mdb = MongoClient(event_listeners=[MongoCommandListener()])[settings.get("api","mdb")]
 
 ymd = "%Y-%m-%d"
 hms = "%H:%M:%S"
@@ -274,37 +332,638 @@ class noUser:
         self.login="admin@kdm-manager.com"
         self._id = "666"
 
+def record_asset_write(collection, _id):
+    """ Notes that the current request has written the '_id' document in
+    'collection' (i.e. in r.asset_writes). request_broker.py uses this to work
+    out whether an action that hit a save conflict is safe to re-do. Does
+    nothing outside of requests. """
+
+    if not request:
+        return False
+    if not hasattr(request, 'asset_writes'):
+        request.asset_writes = []
+    request.asset_writes.append((collection, _id))
+    return True
+
+
+def touch_settlements(settlement_ids):
+    """ Bumps the 'related_revision' of the settlements in 'settlement_ids'.
+    Call this after writing anything that shows up in settlement or survivor
+    responses but isn't a settlement doc, i.e. survivors, notes and events:
+    ETags are a hash of the settlement's 'revision' and 'related_revision'
+    (see request_broker.get_user_asset_etag()).
+
+    This is NOT the 'revision' that save() uses to catch conflicts, i.e.
+    writing a survivor or an event doesn't make saving its settlement fail. """
+
+    settlement_ids = [s_id for s_id in set(settlement_ids) if s_id is not None]
+    if settlement_ids == []:
+        return 0
+    return mdb.settlements.update_many({'_id': {'$in': settlement_ids}}, {'$inc': {'related_revision': 1}}).modified_count
+
+
+def get_cursor(doc):
+    """ Returns an opaque cursor token for 'doc' (e.g. a settlement_events
+    document), for keyset pagination on ('created_on', '_id'). """
+    created_on = doc['created_on']
+    millis = calendar.timegm(created_on.utctimetuple()) * 1000 + created_on.microsecond / 1000
+    return base64.urlsafe_b64encode("%s:%s" % (millis, doc['_id'])).rstrip('=')
+
+
+def parse_cursor(cursor):
+    """ The inverse of get_cursor(): returns a ('created_on', '_id') tuple.
+    Raises an InvalidUsage (i.e. a 400) if 'cursor' isn't one of ours. """
+    try:
+        cursor = str(cursor)
+        millis, oid = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).split(':')
+        return datetime(1970, 1, 1) + timedelta(milliseconds=int(millis)), ObjectId(oid)
+    except Exception:
+        raise InvalidUsage("'%s' is not a valid cursor!" % cursor, status_code=400)
+
+
+def get_cursor_query(field, value, cursor=None, direction='after', horizon=None):
+    """ Returns an MDB query for the documents where 'field' is 'value' that
+    come after (direction='after') or before (direction='before') 'cursor' in
+    ('created_on', '_id') order. Index ('field', 'created_on', '_id') for this,
+    so that it's a range scan rather than a sort.
+
+    If you're going to hand out cursors from the results, set 'horizon' (see
+    get_feed_horizon()) so that the query leaves out the documents that other
+    requests might still be writing. """
+
+    query = {field: value}
+    if cursor is not None:
+        created_on, oid = parse_cursor(cursor)
+        op = '$gt' if direction == 'after' else '$lt'
+        query['$or'] = [
+            {'created_on': {op: created_on}},
+            {'created_on': created_on, '_id': {op: oid}},
+        ]
+    if horizon is not None:
+        query['created_on'] = {'$lte': horizon}
+    return query
+
+
+def get_feed_horizon():
+    """ Returns the latest 'created_on' that event log feeds can safely read
+    up to. EventSink.flush() stamps events right before it inserts them, so
+    an event stamped just now might not be in the MDB yet: if a feed read it
+    would hand out a cursor that's past it, and the client would never see it.
+    Reading 'event_feed_lag' seconds behind now keeps that from happening. """
+    return datetime.now() - timedelta(seconds=settings.get_float('api', 'event_feed_lag'))
+
+
+class PreEncodedResponse:
+    """ A response body that gets encoded once and served over and over, e.g. a
+    game asset catalog that only changes when we deploy. Keeps the body, a
+    strong ETag and (if the body is big enough to be worth it) gzip and deflate
+    copies of the body, so serving it costs a dict lookup instead of a
+    json.dumps() and a compression pass.
+
+    Use response() to get a Flask response: it picks an encoding based on the
+    request's Accept-Encoding header and returns a 304 if the request's
+    If-None-Match header has the ETag of that encoding. """
+
+    def __init__(self, body, mimetype="application/json"):
+
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+
+        self.mimetype = mimetype
+        self.digest = hashlib.sha1(body).hexdigest()
+        self.encodings = {'identity': body}
+
+        if len(body) >= settings.get_int('api', 'compress_min_bytes'):
+            level = settings.get_int('api', 'compress_level')
+            self.encodings['deflate'] = zlib.compress(body, level)
+            buf = StringIO.StringIO()
+            gz = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0)
+            gz.write(body)
+            gz.close()
+            self.encodings['gzip'] = buf.getvalue()
+
+
+    def get_encoding(self, r):
+        """ Returns the best encoding we've got that 'r' (a request) accepts. """
+        for encoding in ['gzip', 'deflate']:
+            if encoding in self.encodings and r.accept_encodings[encoding]:
+                return encoding
+        return 'identity'
+
+
+    def get_etag(self, encoding='identity'):
+        """ Strong ETags have to be different for each encoding of a resource,
+        so non-identity encodings get a suffix. """
+        if encoding == 'identity':
+            return self.digest
+        return "%s-%s" % (self.digest, encoding)
+
+
+    def response(self, r=None):
+        """ Returns a Flask response for 'r', which is the current request if
+        you don't specify one. Only GET and HEAD requests get 304s. """
+
+        if r is None:
+            r = request
+
+        encoding = self.get_encoding(r)
+        etag = self.get_etag(encoding)
+
+        if r.method in ['GET', 'HEAD'] and r.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = Response(response=self.encodings[encoding], status=200, mimetype=self.mimetype)
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'public, max-age=%s' % settings.get_int('api', 'catalog_max_age')
+        return response
+
+
 #
 #   performance monitoring
 #
 
+class request_span(object):
+    """ Times a phase of the current request, e.g. 'auth' or 'serialize'. Use
+    it as a context manager:
+
+        with utils.request_span('load'):
+            S = settlements.Settlement(_id=asset_id)
+
+    ...or as a method decorator, i.e. @utils.request_span('serialize').
+
+    Phase times are exclusive, i.e. time spent in a nested span is counted
+    toward that span and not its parent, and they pile up in the request's
+    'phase_times' dict, which record_response_time() picks up.
+
+    Outside of a request, this does nothing. """
+
+    def __init__(self, name):
+        self.name = name
+        self.active = False
+
+
+    def __enter__(self):
+        if not request:
+            return self
+        if not hasattr(request, 'span_stack'):
+            request.span_stack = []
+            request.phase_times = {}
+        self.active = True
+        self.child_time = 0.0
+        self.start = time.time()
+        request.span_stack.append(self)
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if not self.active:
+            return False
+        elapsed = time.time() - self.start
+        request.span_stack.pop()
+        if request.span_stack != []:
+            request.span_stack[-1].child_time += elapsed
+        request.phase_times[self.name] = request.phase_times.get(self.name, 0.0) + elapsed - self.child_time
+        return False
+
+
+    def __call__(self, func):
+        def wrapper(*args, **kwargs):
+            with request_span(self.name):
+                return func(*args, **kwargs)
+        return update_wrapper(wrapper, func)
+
+
+    @classmethod
+    def add_child_time(cls, name, seconds):
+        """ Adds 'seconds' to the 'name' phase of the current request, as if
+        it had been a span nested inside whatever span is open. Use this for
+        things that time themselves, e.g. MDB commands. """
+
+        if not request or not hasattr(request, 'start_time'):
+            return False
+        if not hasattr(request, 'span_stack'):
+            request.span_stack = []
+            request.phase_times = {}
+        if request.span_stack != []:
+            request.span_stack[-1].child_time += seconds
+        request.phase_times[name] = request.phase_times.get(name, 0.0) + seconds
+        return True
+
+
+class ResponseTimeMetrics:
+    """ Per-process request metrics. Rather than writing a document for every
+    request, we keep a count, total, min, max and a histogram for each route
+    template and method in memory, and every 'flush_interval' seconds, we
+    $inc them into the (hourly) bucket documents in the
+    mdb.api_response_time_buckets collection.
+
+    We also keep a total and a histogram for each phase of the request (see
+    request_span), so that we can tell where the time went.
+
+    The buckets have a TTL index on 'created_on', so Mongo expires them after
+    'metrics_retention_days', i.e. we never have to delete anything. """
+
+    # histogram bucket upper bounds, in seconds; there's one more slot in the
+    # histogram for everything that's slower than the last bound
+    histogram_bounds = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.last_flush = time.time()
+        self.flush_interval = settings.get("api", "metrics_flush_interval")
+        self.indexes_created = False
+        atexit.register(self.flush)
+
+
+    @classmethod
+    def get_percentile(cls, histogram, percentile, max_time=None):
+        """ Estimates a percentile (e.g. 0.9) from a histogram dict, i.e.
+        {slot: count}, where slots can be ints or strings. Interpolates
+        linearly within the slot that has the percentile in it. """
+
+        histogram = dict([(int(k), v) for k, v in histogram.iteritems()])
+        count = sum(histogram.values())
+        if count == 0:
+            return None
+
+        target = percentile * count
+        seen = 0
+        for slot in sorted(histogram.keys()):
+            if seen + histogram[slot] >= target:
+                lower = 0.0
+                if slot > 0:
+                    lower = cls.histogram_bounds[slot - 1]
+                if slot < len(cls.histogram_bounds):
+                    upper = cls.histogram_bounds[slot]
+                else:
+                    upper = max(max_time, lower) if max_time is not None else lower
+                return lower + (upper - lower) * ((target - seen) / float(histogram[slot]))
+            seen += histogram[slot]
+
+
+    def record(self, url, method, seconds, phase_times={}, mongo_stats=None):
+        """ Records a response time (and the times of its phases and its MDB
+        command stats) and flushes, if it's time to. """
+
+        slot = bisect.bisect_left(self.histogram_bounds, seconds)
+
+        with self.lock:
+            r = self.routes.get((url, method), None)
+            if r is None:
+                r = {
+                    "count": 0, "total": 0.0, "min": seconds, "max": seconds, "histogram": {}, "phases": {},
+                    "mongo": {"count": 0, "docs": 0, "time": 0.0, "max_count": 0},
+                }
+                self.routes[(url, method)] = r
+            r["count"] += 1
+            r["total"] += seconds
+            r["min"] = min(r["min"], seconds)
+            r["max"] = max(r["max"], seconds)
+            r["histogram"][slot] = r["histogram"].get(slot, 0) + 1
+
+            if mongo_stats is not None:
+                r["mongo"]["count"] += mongo_stats["count"]
+                r["mongo"]["docs"] += mongo_stats["docs"]
+                r["mongo"]["time"] += mongo_stats["time"]
+                r["mongo"]["max_count"] = max(r["mongo"]["max_count"], mongo_stats["count"])
+
+            for phase, phase_seconds in phase_times.iteritems():
+                p = r["phases"].setdefault(phase, {"count": 0, "total": 0.0, "histogram": {}})
+                p_slot = bisect.bisect_left(self.histogram_bounds, phase_seconds)
+                p["count"] += 1
+                p["total"] += phase_seconds
+                p["histogram"][p_slot] = p["histogram"].get(p_slot, 0) + 1
+
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+
+    def create_indexes(self):
+        """ Creates the bucket collection's indexes, including the TTL index
+        that handles retention. """
+
+        collection = mdb.api_response_time_buckets
+        collection.create_index([("url", 1), ("method", 1), ("period_start", 1)], unique=True)
+        collection.create_index("created_on", expireAfterSeconds=settings.get("api", "metrics_retention_days") * 86400)
+        self.indexes_created = True
+
+
+    def flush(self):
+        """ Writes everything we've got to the current hourly buckets, in one
+        bulk_write() call, and resets. """
+
+        with self.lock:
+            routes, self.routes = self.routes, {}
+            self.last_flush = time.time()
+
+        if routes == {}:
+            return 0
+
+        if not self.indexes_created:
+            self.create_indexes()
+
+        period_start = datetime.now().replace(minute=0, second=0, microsecond=0)
+        updates = []
+        for (url, method), r in routes.iteritems():
+            increments = {"count": r["count"], "total": r["total"]}
+            for slot, count in r["histogram"].iteritems():
+                increments["histogram.%s" % slot] = count
+            for phase, p in r["phases"].iteritems():
+                phase = phase.replace('.', '_')     # dots would nest in the MDB doc
+                increments["phases.%s.count" % phase] = p["count"]
+                increments["phases.%s.total" % phase] = p["total"]
+                for slot, count in p["histogram"].iteritems():
+                    increments["phases.%s.histogram.%s" % (phase, slot)] = count
+            for k in ["count", "docs", "time"]:
+                increments["mongo.%s" % k] = r["mongo"][k]
+            updates.append(UpdateOne(
+                {"url": url, "method": method, "period_start": period_start},
+                {
+                    "$inc": increments,
+                    "$min": {"min": r["min"]},
+                    "$max": {"max": r["max"], "mongo.max_count": r["mongo"]["max_count"]},
+                    "$setOnInsert": {"created_on": period_start},
+                },
+                upsert=True,
+            ))
+
+        mdb.api_response_time_buckets.bulk_write(updates, ordered=False)
+        return len(updates)
+
+
+response_time_metrics = ResponseTimeMetrics()
+
 def record_response_time(r):
-    """ Accepts a request object, uses it to log the request and its response
-    time to mdb. Prunes old lines. """
-    duration = request.stop_time - r.start_time
+    """ Accepts a request object and records its response time (by route
+    template and method) in the process's ResponseTimeMetrics object. """
 
-    url_list = request.url.split(request.url_root)[1].split("/")
-    for i in url_list:
-        try:
-            ObjectId(i)
-            url_list.remove(i)
-        except:
-            pass
-    url = "/".join(url_list)
+    duration = r.stop_time - r.start_time
+
+    url = "UNKNOWN"
+    if r.url_rule is not None:
+        url = r.url_rule.rule.lstrip("/")
 
-    mdb.api_response_times.insert({
-       "created_on": datetime.now(),
-       "url": url,
-       "method": request.method,
-       "time": duration.total_seconds()
-    })
+    # whatever isn't in a span is 'other'
+    phase_times = dict(getattr(r, 'phase_times', {}))
+    phase_times['other'] = max(duration.total_seconds() - sum(phase_times.values()), 0.0)
 
-    if request.metering:
-        request.logger = get_logger()
-        request.logger.debug('[%s] %s response in %s ' % (request.method, request.url, duration))
+    mongo_stats = getattr(r, 'mongo_stats', {"count": 0, "docs": 0, "time": 0.0, "commands": {}})
+    response_time_metrics.record(url, r.method, duration.total_seconds(), phase_times, mongo_stats)
 
-    old_record_query = {"created_on": {"$lt": (datetime.now() - timedelta(days=7))}}
-    removed_records = mdb.api_response_times.remove(old_record_query)
+    if r.metering:
+        r.logger = get_logger()
+        r.logger.debug('[%s] %s response in %s (%s)' % (r.method, r.url, duration, get_server_timing_header(r)))
+
+    # complain about requests that do a suspicious number of MDB commands
+    if mongo_stats["count"] > settings.get("api", "mongo_query_threshold"):
+        top_commands = sorted(mongo_stats["commands"].items(), key=lambda c: c[1], reverse=True)[:5]
+        get_logger().warn('[%s] %s made %s MDB commands (%s docs, %.3fs)! Top commands: %s' % (
+            r.method, r.url, mongo_stats["count"], mongo_stats["docs"], mongo_stats["time"],
+            ", ".join(["%s x%s" % c for c in top_commands]),
+        ))
+
+
+def get_server_timing_header(r):
+    """ Returns a Server-Timing header value (e.g. 'auth;dur=3.1, load;dur=22.8')
+    for a request object's phase times. """
+
+    phase_times = getattr(r, 'phase_times', {})
+    timings = ["%s;dur=%.1f" % (phase, phase_times[phase] * 1000) for phase in sorted(phase_times.keys())]
+    timings.append("total;dur=%.1f" % ((datetime.now() - r.start_time).total_seconds() * 1000))
+    return ", ".join(timings)
+
+
+def start_request_profile(r):
+    """ Starts a cProfile profiler for the request, for a random sample of
+    requests (see 'profile_sample_rate' in settings.cfg). """
+
+    sample_rate = float(settings.get("api", "profile_sample_rate"))
+    if sample_rate <= 0 or random.random() >= sample_rate:
+        return False
+    r.profiler = cProfile.Profile()
+    r.profiler.enable()
+    return True
+
+
+def finish_request_profile(r):
+    """ Stops the request's profiler (if it has one) and dumps its stats to
+    the 'profile_dir' set in settings.cfg, which you can look at with pstats,
+    snakeviz, etc. """
+
+    profiler = getattr(r, 'profiler', None)
+    if profiler is None:
+        return False
+    profiler.disable()
+    r.profiler = None
+
+    profile_dir = settings.get("api", "profile_dir")
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+
+    route = "root"
+    if r.url_rule is not None:
+        route = r.url_rule.rule.strip("/").replace("/", "_").replace("<", "").replace(">", "")
+    file_name = "%s_%s_%s.prof" % (datetime.now().strftime("%Y%m%d%H%M%S%f"), r.method, route)
+    profiler.dump_stats(os.path.join(profile_dir, file_name))
+    return True
+
+
+#
+#   settlement event writer
+#
+
+class EventSink:
+    """ Accumulates settlement_events documents (i.e. the output of
+    Models.UserAsset.log_event()) and writes them all to the MDB with one
+    insert_many() call when flush() is called.
+
+    The API gives every request one of these (see api.py), so events only get
+    written once per request, no matter how many of them an action makes.
+
+    Latest action updates are coalesced, i.e. we only keep the last one for
+    each user, and flush() does one set_latest_action() per user. """
+
+    def __init__(self, flush_interval=0):
+        self.lock = threading.Lock()
+        self.events = []
+        self.latest_actions = OrderedDict()
+        self.flush_interval = flush_interval
+        self.flusher = None
+
+
+    def __repr__(self):
+        return "[EventSink (%s events)]" % len(self.events)
+
+
+    def add_event(self, event_doc):
+        """ Adds a settlement_events document to the queue. """
+        with self.lock:
+            self.events.append(event_doc)
+
+
+    def set_latest_action(self, User, activity_string=None, ua_string=None):
+        """ Queues a latest action update for 'User'. Replaces any update that
+        is already queued for that user. """
+        with self.lock:
+            self.latest_actions[User._id] = (User, activity_string, ua_string)
+
+
+    def merge(self, other_sink):
+        """ Moves everything queued in 'other_sink' to this one. Starts the
+        background flusher, if this sink has a 'flush_interval'. """
+
+        with other_sink.lock:
+            events, other_sink.events = other_sink.events, []
+            actions, other_sink.latest_actions = other_sink.latest_actions, OrderedDict()
+
+        with self.lock:
+            self.events.extend(events)
+            self.latest_actions.update(actions)
+
+        if self.flush_interval and self.flusher is None:
+            self.flusher = threading.Thread(target=self.flush_forever, name="EventSink flusher")
+            self.flusher.daemon = True
+            self.flusher.start()
+
+
+    def flush(self):
+        """ Writes all queued events and latest action updates to the MDB.
+        Returns the number of events that were written. """
+
+        with self.lock:
+            events, self.events = self.events, []
+            actions, self.latest_actions = self.latest_actions, OrderedDict()
+
+        # stamp events when they're written, not when they were logged; see
+        #   get_feed_horizon() for why
+        now = datetime.now()
+        for event in events:
+            event['created_on'] = now
+
+        if events != []:
+            mdb.settlement_events.insert_many(events)
+            touch_settlements([e.get('settlement_id', None) for e in events])
+            event_broker.publish(events)
+        for User, activity_string, ua_string in actions.values():
+            User.set_latest_action(activity_string, ua_string)
+
+        return len(events)
+
+
+    def flush_forever(self):
+        """ Background flusher loop. Never returns. """
+        logger = get_logger()
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("%s could not flush queued events!" % self)
+                logger.exception(e)
+
+
+shared_event_sink = None
+shared_event_sink_lock = threading.Lock()
+
+def create_indexes():
+    """ Makes sure we've got the MDB indexes that the API's hot paths need
+    (create_index() doesn't do anything if an index already exists). The API
+    calls this once, at startup. """
+
+    # event log pages and feeds (see Settlement.get_event_log())
+    mdb.settlement_events.create_index([('settlement_id', 1), ('created_on', 1), ('_id', 1)])
+    mdb.settlement_events.create_index([('survivor_id', 1), ('created_on', 1), ('_id', 1)])
+
+    # settlement survivor and note lookups
+    mdb.survivors.create_index('settlement')
+    mdb.settlement_notes.create_index([('settlement', 1), ('created_on', 1)])
+    mdb.survivor_notes.create_index([('survivor_id', 1), ('created_on', 1)])
+
+
+def get_shared_event_sink():
+    """ Returns the process-wide EventSink that requests hand their events off
+    to when 'event_flush_interval' in settings.cfg is more than zero. """
+
+    global shared_event_sink
+    with shared_event_sink_lock:
+        if shared_event_sink is None:
+            shared_event_sink = EventSink(flush_interval=settings.get("api", "event_flush_interval"))
+            atexit.register(shared_event_sink.flush)
+        return shared_event_sink
+
+
+def flush_request_events(r, force=False):
+    """ Accepts a request object and writes its queued events, i.e. the ones in
+    r.event_sink. Hands them off to the shared (background) sink instead, if
+    we're configured to do that and 'force' is False. """
+
+    if not hasattr(r, 'event_sink'):
+        return False
+
+    if settings.get("api", "event_flush_interval") and not force:
+        get_shared_event_sink().merge(r.event_sink)
+    else:
+        r.event_sink.flush()
+    return True
+
+
+class EventBroker:
+    """ In-process pub/sub for settlement events. Event log streams (see
+    Settlement.stream_event_log()) subscribe to a settlement and get woken up
+    when an event for it gets written, i.e. by EventSink.flush().
+
+    Subscriptions are threading.Event objects: subscribers wait() on them and
+    then read the new events from the MDB with a cursor, so they don't double
+    up on events, and events written by other processes show up too (just not
+    right away: subscribers don't wait() forever). Subscribers have to stay
+    behind get_feed_horizon() to avoid skipping events that are still being
+    written. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+
+    def __repr__(self):
+        return "[EventBroker (%s settlements)]" % len(self.subscribers)
+
+
+    def get_subscription_count(self):
+        """ Returns the number of open subscriptions, i.e. open streams. """
+        with self.lock:
+            return sum([len(s) for s in self.subscribers.values()])
+
+
+    def subscribe(self, settlement_id):
+        """ Returns a new subscription to 'settlement_id'. """
+        subscription = threading.Event()
+        with self.lock:
+            self.subscribers.setdefault(settlement_id, set()).add(subscription)
+        return subscription
+
+
+    def unsubscribe(self, settlement_id, subscription):
+        with self.lock:
+            subscriptions = self.subscribers.get(settlement_id, set())
+            subscriptions.discard(subscription)
+            if subscriptions == set():
+                self.subscribers.pop(settlement_id, None)
+
+
+    def publish(self, events):
+        """ Wakes up everybody subscribed to the settlements of 'events' (a
+        list of settlement_events docs). """
+        with self.lock:
+            for settlement_id in set([e.get('settlement_id', None) for e in events]):
+                for subscription in self.subscribers.get(settlement_id, []):
+                    subscription.set()
+
+event_broker = EventBroker()
 
 
 #
@@ -338,7 +997,7 @@ class mailSession:
 
     def __init__(self):
         self.logger = get_logger()
-        p_settings = settings.Settings('private')
+        p_settings = settings.get_settings('private')
         self.smtp_host = p_settings.get("smtp","host")
         self.smtp_user = p_settings.get("smtp","name")
         self.smtp_pass = p_settings.get("smtp","pass")
@@ -354,9 +1013,22 @@ class mailSession:
         time.sleep(0.75)
 
 
-    def send(self, reply_to=None, recipients=["toconnell@tyrannybelle.com"], html_msg='This is a <b>test</b> message!', subject="KDM-Manager!"):
+    def close(self):
+        """ Closes the SMTP connection. """
+        try:
+            self.server.quit()
+        except smtplib.SMTPException:
+            pass
+
+
+    def send(self, reply_to=None, recipients=["toconnell@tyrannybelle.com"], html_msg='This is a <b>test</b> message!', subject="KDM-Manager!", quit=True):
         """ Generic Emailer. Accepts a list of 'recipients', a 'msg' string and a
-        sender name (leave undefinied to use admin@kdm-manager.com). """
+        sender name (leave undefinied to use admin@kdm-manager.com).
+
+        Set 'quit' to False to keep the connection open for another send().
+
+        This talks to the SMTP server, i.e. it blocks: if you're in a request,
+        use queue_email() instead. """
 
         author = email.utils.formataddr((str(email_Header(self.sender_name, 'utf-8')), self.no_reply))
         msg = MIMEMultipart('alternative')
@@ -370,11 +1042,137 @@ class mailSession:
         msg.attach(MIMEText(html_msg.encode('ascii','ignore'),'html'))
 
         self.server.sendmail(self.no_reply, recipients, msg.as_string())
-        self.server.quit()
+        if quit:
+            self.server.quit()
         self.logger.debug("Email sent successfully!")
 
 
 
+class MailOutbox:
+    """ A persistent outbox for email, i.e. the mdb.mail_outbox collection.
+    queue() inserts a message and makes sure that this process has a worker
+    thread running; the worker claims queued messages one at a time (so that
+    workers in other processes don't send them twice) and sends them over one
+    SMTP connection, no faster than 'mail_rate_limit' messages per second.
+
+    The worker exits when the outbox is empty and the next queue() starts a
+    new one. Messages claimed by a worker that died get re-queued after
+    'mail_claim_timeout' seconds; messages that fail 'mail_max_attempts' times
+    are marked 'failed' and left alone. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.worker = None
+        self.indexes_created = False
+
+
+    def queue(self, recipients=[], html_msg=None, subject="KDM-Manager!", reply_to=None):
+        """ Queues a message. Takes the same kwargs as mailSession.send(). """
+
+        if isinstance(html_msg, str):
+            html_msg = html_msg.decode('utf-8', 'replace')
+
+        result = mdb.mail_outbox.insert_one({
+            'created_on': datetime.now(),
+            'status': 'queued',
+            'attempts': 0,
+            'recipients': recipients,
+            'subject': subject,
+            'html_msg': html_msg,
+            'reply_to': reply_to,
+        })
+        record_asset_write('mail_outbox', result.inserted_id)
+        self.start_worker()
+
+
+    def start_worker(self):
+        """ Starts the worker thread, unless it's already running. """
+        with self.lock:
+            if self.worker is not None and self.worker.is_alive():
+                return False
+            self.worker = threading.Thread(target=self.work, name="MailOutbox worker")
+            self.worker.daemon = True
+            self.worker.start()
+        return True
+
+
+    def create_indexes(self):
+        mdb.mail_outbox.create_index([('status', 1), ('created_on', 1)])
+        mdb.mail_outbox.create_index('sent_on', expireAfterSeconds=30 * 86400)
+        self.indexes_created = True
+
+
+    def claim(self):
+        """ Claims the oldest queued (or stale) message and returns it. """
+
+        stale_cutoff = datetime.now() - timedelta(seconds=settings.get("api", "mail_claim_timeout"))
+        return mdb.mail_outbox.find_one_and_update(
+            {'$or': [
+                {'status': 'queued'},
+                {'status': 'sending', 'claimed_on': {'$lt': stale_cutoff}},
+            ]},
+            {
+                '$set': {'status': 'sending', 'claimed_on': datetime.now(), 'claimed_by': "%s:%s" % (socket.gethostname(), os.getpid())},
+                '$inc': {'attempts': 1},
+            },
+            sort=[('created_on', 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+
+    def work(self):
+        """ Worker loop: sends messages until there aren't any. """
+
+        if not self.indexes_created:
+            self.create_indexes()
+
+        logger = get_logger(log_name="mail")
+        session = None
+        min_interval = 1.0 / settings.get_float("api", "mail_rate_limit")
+
+        while True:
+            m = self.claim()
+            if m is None:
+                # last look, under the lock, so that a queue() that saw us
+                # running right before we quit doesn't get stranded
+                with self.lock:
+                    m = self.claim()
+                    if m is None:
+                        self.worker = None
+                        break
+
+            started = time.time()
+            try:
+                if session is None:
+                    session = mailSession()
+                session.send(reply_to=m['reply_to'], recipients=m['recipients'], html_msg=m['html_msg'], subject=m['subject'], quit=False)
+                mdb.mail_outbox.update_one({'_id': m['_id']}, {'$set': {'status': 'sent', 'sent_on': datetime.now()}})
+            except Exception as e:
+                logger.error("Could not send '%s' to %s! (attempt %s)" % (m['subject'], m['recipients'], m['attempts']))
+                logger.exception(e)
+                status = 'queued'
+                if m['attempts'] >= settings.get("api", "mail_max_attempts"):
+                    status = 'failed'
+                mdb.mail_outbox.update_one({'_id': m['_id']}, {'$set': {'status': status, 'last_error': str(e)}})
+                if session is not None:
+                    session.close()
+                session = None
+                if status == 'queued':
+                    time.sleep(min_interval * 10)   # don't hammer a sick server
+
+            time.sleep(max(min_interval - (time.time() - started), 0))
+
+        if session is not None:
+            session.close()
+
+mail_outbox = MailOutbox()
+
+def queue_email(**kwargs):
+    """ Laziness/convenience function for mail_outbox.queue(). """
+    mail_outbox.queue(**kwargs)
+
+
+
 # general usage methods
 
 def basic_logging():
@@ -387,29 +1185,97 @@ def basic_logging():
         level = settings.get("server","log_level"),
     )
 
+#
+#   logging: get_logger() configures one logger (and one FileHandler per log
+#   file) per process, and then just hands them out
+#
+
+loggers = {}        # (log_file_name, level) -> logging.Logger
+log_handlers = {}   # log file path -> logging.Handler
+log_registry_lock = threading.Lock()
+
+
+class QueueingHandler(logging.Handler):
+    """ Py2.7 doesn't have logging.handlers.QueueHandler, so this is ours. It
+    puts records on a Queue and a daemon thread hands them to 'target_handler',
+    i.e. the file I/O happens off of the request thread.
+
+    Turn it on with 'log_in_background' in the [application] section of
+    settings.cfg. """
+
+    def __init__(self, target_handler):
+        logging.Handler.__init__(self)
+        self.target_handler = target_handler
+        self.queue = Queue.Queue()
+        self.listener = threading.Thread(target=self.listen, name="QueueingHandler listener")
+        self.listener.daemon = True
+        self.listener.start()
+        atexit.register(self.drain)
+
+
+    def emit(self, record):
+        """ Merges args and exception info into the record (so that it can
+        be formatted later, on the other thread) and queues it. """
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+    def listen(self):
+        while True:
+            self.target_handler.handle(self.queue.get())
+
+
+    def drain(self):
+        """ Writes anything still queued. Called at exit. """
+        while not self.queue.empty():
+            self.target_handler.handle(self.queue.get_nowait())
+
+
+def get_log_handler(log_path):
+    """ Returns the handler for 'log_path', creating it if necessary. """
+
+    if log_path not in log_handlers:
+        handler = logging.FileHandler(log_path)
+        handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s:\t%(message)s', ymdhms))
+        if settings.get("application", "log_in_background"):
+            handler = QueueingHandler(handler)
+        log_handlers[log_path] = handler
+    return log_handlers[log_path]
+
+
 def get_logger(log_level=None, log_name=None):
-    """ Initialize a logger, specifying a new file if necessary. """
-    logger = logging.getLogger(__name__)
-
-    if len(logger.handlers):    # if we're initializing a log, kill whatever other
-        logger.handlers = []    # handlers are open, so that the latest init wins
-
-    if not len(logger.handlers):    # if it's not already open, open it
-
-        # set the file name or default to the script asking for the logger
-        log_file_name = log_name
-        if log_name is None:
-            log_file_name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
-        log_handler_level = log_level
-
-        # do the same for log level, defaulting to the server's 'log_level'
-        if log_handler_level is None:
-            logger.setLevel(settings.get("server","log_level"))
-        elif type(log_handler_level) == str:
-            exec 'log_level_obj = logging.%s' % log_level
-            logger.setLevel(log_level_obj)
-        else:
-            logger.setLevel(log_handler_level)
+    """ Returns a logger that writes to 'log_name'.log in the log root dir (or
+    to a file named after the script asking for the logger, if 'log_name' is
+    None).
+
+    Loggers are only configured once per (name, level) per process, so this
+    is cheap to call, e.g. from asset object constructors. """
+
+    # set the file name or default to the script asking for the logger
+    log_file_name = log_name
+    if log_name is None:
+        log_file_name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+
+    # do the same for log level, defaulting to the server's 'log_level'
+    if log_level is None:
+        log_level = settings.get("server","log_level")
+    elif type(log_level) == str:
+        log_level = getattr(logging, log_level)
+
+    logger = loggers.get((log_file_name, log_level), None)
+    if logger is not None:
+        return logger
+
+    with log_registry_lock:
+        if (log_file_name, log_level) in loggers:
+            return loggers[(log_file_name, log_level)]
 
         # now check the logging root, just as a precaution
         log_root_dir = settings.get("application","log_root_dir")
@@ -417,14 +1283,12 @@ def get_logger(log_level=None, log_name=None):
             e = Exception("Logging root dir '%s' does not exist!" % log_root_dir)
             raise e
 
-        # create the path and add it to the handler
-        log_path = os.path.join(log_root_dir, log_file_name + ".log")
-        logger_fh = logging.FileHandler(log_path)
+        logger = logging.getLogger("%s.%s.%s" % (__name__, log_file_name, logging.getLevelName(log_level)))
+        logger.setLevel(log_level)
+        logger.propagate = False
+        logger.handlers = [get_log_handler(os.path.join(log_root_dir, log_file_name + ".log"))]
 
-        #   set the formatter and add it via addHandler()
-        formatter =  logging.Formatter('[%(asctime)s] %(levelname)s:\t%(message)s', ymdhms)
-        logger_fh.setFormatter(formatter)
-        logger.addHandler(logger_fh)
+        loggers[(log_file_name, log_level)] = logger
 
     return logger
 
@@ -522,6 +1386,7 @@ def crossdomain(origin=None, methods=None, headers=None, max_age=21600, attach_t
             h['Access-Control-Allow-Origin'] = origin
             h['Access-Control-Allow-Methods'] = get_methods()
             h['Access-Control-Max-Age'] = str(max_age)
+            h['Access-Control-Expose-Headers'] = 'ETag'
             if headers is not None:
                 h['Access-Control-Allow-Headers'] = headers
             return resp
@@ -577,8 +1442,7 @@ def email_exception(exception):
 
     # do it
     s = msg.safe_substitute(traceback=tb, user_login=request.User.login, user_oid=request.User._id, datetime=datetime.now(), r_method=request.method, r_url=request.url, r_json=request.json)
-    e = mailSession()
-    e.send(subject="API Error! [%s]" % socket.getfqdn(), recipients=['toconnell@tyrannybelle.com'], html_msg=s)
+    queue_email(subject="API Error! [%s]" % socket.getfqdn(), recipients=['toconnell@tyrannybelle.com'], html_msg=s)
 
 
 
@@ -11,15 +11,12 @@ from pwd import getpwuid, getpwnam
 
 
 # general imports
-from bson.son import SON
-from bson import json_util
 from bson.objectid import ObjectId
 import collections
 from copy import copy
 import daemon
 from datetime import datetime, timedelta
 from flask import request
-import json
 from lockfile.pidlockfile import PIDLockFile
 from optparse import OptionParser
 from retry import retry
@@ -38,6 +35,7 @@ from models import settlements as settlements_models
 from models import survivors as survivors_models
 from models import campaigns as campaigns_models
 from models import epithets as epithets_models
+import encoders
 import notifications
 import utils
 
@@ -264,7 +262,7 @@ class World:
         elif output_type == dict:
             return d
         elif output_type == "JSON":
-            return json.dumps(d, default=json_util.default)
+            return encoders.dumps(d)
 
 
     def dump(self, asset_handle):
@@ -488,24 +486,61 @@ class World:
 
     # application/meta
     def api_response_times(self):
-        results = utils.mdb.api_response_times.aggregate([
-            {"$group": {
-                "_id": {
-                    "url": "$url",
-                    "method": "$method",
-                },
-                "avg_time": { "$avg": "$time" },
-                "last_24_avg": {
-                    "$avg": {"$gte": ["$time", datetime.now()-timedelta(days=1)]},
-                },
-                "max_time": { "$max": "$time" },
-                "min_time": { "$min": "$time" },
-                "count": {"$sum": 1 },
-                },
-            },
-            {"$sort": SON([("_id", 1)])},
-        ])
-        return [r for r in results]
+        """ Rolls up the hourly buckets that utils.ResponseTimeMetrics writes
+        (i.e. the last seven days, give or take the TTL) by route/method.
+
+        Percentiles (overall and for each request phase) are estimated from
+        the merged histograms, so we do the merging here, rather than in an
+        aggregation pipeline. """
+
+        yesterday = datetime.now() - timedelta(days=1)
+        get_percentile = utils.ResponseTimeMetrics.get_percentile
+
+        routes = {}
+        for b in utils.mdb.api_response_time_buckets.find():
+            r = routes.setdefault((b['url'], b['method']), {
+                '_id': {'url': b['url'], 'method': b['method']},
+                'count': 0, 'total': 0.0, 'last_24_count': 0, 'last_24_total': 0.0,
+                'min_time': b['min'], 'max_time': b['max'], 'histogram': {}, 'phases': {},
+            })
+            r['count'] += b['count']
+            r['total'] += b['total']
+            if b['period_start'] >= yesterday.replace(minute=0, second=0, microsecond=0):
+                r['last_24_count'] += b['count']
+                r['last_24_total'] += b['total']
+            r['min_time'] = min(r['min_time'], b['min'])
+            r['max_time'] = max(r['max_time'], b['max'])
+            for slot, count in b.get('histogram', {}).iteritems():
+                r['histogram'][slot] = r['histogram'].get(slot, 0) + count
+            for phase, p in b.get('phases', {}).iteritems():
+                merged = r['phases'].setdefault(phase, {'count': 0, 'total': 0.0, 'histogram': {}})
+                merged['count'] += p['count']
+                merged['total'] += p['total']
+                for slot, count in p['histogram'].iteritems():
+                    merged['histogram'][slot] = merged['histogram'].get(slot, 0) + count
+
+        output = []
+        for key in sorted(routes.keys()):
+            r = routes[key]
+            r['avg_time'] = r['total'] / r['count']
+            r['last_24_avg'] = None
+            if r['last_24_count']:
+                r['last_24_avg'] = r['last_24_total'] / r['last_24_count']
+            for pct in [50, 90, 99]:
+                r['p%s' % pct] = get_percentile(r['histogram'], pct / 100.0, r['max_time'])
+
+            phases = {}
+            for phase, p in r['phases'].iteritems():
+                phases[phase] = {'avg_time': p['total'] / p['count']}
+                for pct in [50, 90, 99]:
+                    phases[phase]['p%s' % pct] = get_percentile(p['histogram'], pct / 100.0, r['max_time'])
+            r['phases'] = phases
+
+            for k in ['total', 'last_24_count', 'last_24_total', 'histogram']:
+                del r[k]
+            output.append(r)
+
+        return output
 
     # survivors
     def total_survivors(self):